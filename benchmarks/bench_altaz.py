@@ -0,0 +1,50 @@
+'''Benchmark the 'fast' alt/az engine against astroplan's Observer.altaz
+for a night grid (5-minute steps) and catalogs of increasing size.
+
+   python benchmarks/bench_altaz.py --sizes 10 100 1000 3000
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.compute import makeTimeRange, fastAltAz
+from astroplan import Observer, FixedTarget
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astropy import units as u
+
+def separation(alt1, az1, alt2, az2):
+   '''Angular distance (arcsec) between two alt/az positions (degrees)'''
+   alt1,az1,alt2,az2 = [np.radians(x) for x in (alt1,az1,alt2,az2)]
+   c = np.sin(alt1)*np.sin(alt2) + np.cos(alt1)*np.cos(alt2)*np.cos(az1-az2)
+   return np.degrees(np.arccos(np.clip(c, -1, 1)))*3600
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--sizes', type=int, nargs='+',
+                       default=[10,100,1000,3000])
+   args = parser.parse_args()
+
+   obs = Observer.at_site('LCO')
+   times = makeTimeRange(Time.now())['times']
+   rng = np.random.default_rng(1)
+   print("{} times per target".format(len(times)))
+   print("{:>8s} {:>12s} {:>10s} {:>8s} {:>14s}".format('targets',
+         'astropy (s)','fast (s)','speedup','max err (")'))
+   for N in args.sizes:
+      RA = rng.uniform(0, 24, N)
+      DE = np.degrees(np.arcsin(rng.uniform(-1, 0.7, N)))
+      t0 = time.perf_counter()
+      t = FixedTarget(SkyCoord(RA, DE, unit=(u.hourangle, u.degree)))
+      aa = obs.altaz(times, t, grid_times_targets=True)
+      alt1,az1 = aa.alt.to('degree').value,aa.az.to('degree').value
+      t1 = time.perf_counter()
+      alt2,az2 = fastAltAz(RA, DE, times)
+      t2 = time.perf_counter()
+      err = separation(alt1, az1, alt2, az2)[alt1 > 0]
+      print("{:8d} {:12.3f} {:10.3f} {:8.1f} {:14.1f}".format(N, t1-t0, t2-t1,
+            (t1-t0)/(t2-t1), err.max()))
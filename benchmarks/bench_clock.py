@@ -0,0 +1,54 @@
+'''Benchmark the per-tick cost of the UT/LT/ST status strings:
+compute.computeTimes (astropy) versus the shared compute.clock.
+
+   python benchmarks/bench_clock.py --ticks 1000
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.compute import computeTimes, SiderealClock
+from astropy.time import Time
+
+def hms(s):
+   h,m,sec = [int(x) for x in s.split(':')]
+   return h*3600 + m*60 + sec
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--ticks', type=int, default=1000)
+   args = parser.parse_args()
+
+   now = time.time()
+   clock = SiderealClock()
+   clock.strings(now)        # anchor outside the timing loop
+   N = max(args.ticks//100, 10)
+   t0 = time.perf_counter()
+   for i in range(N):
+      computeTimes(Time(now + i, format='unix'))
+   tastropy = (time.perf_counter() - t0)/N
+   t0 = time.perf_counter()
+   for i in range(args.ticks):
+      # a new second every tick, so the per-second cache never hits
+      clock.strings(now + i)
+   tclock = (time.perf_counter() - t0)/args.ticks
+   t0 = time.perf_counter()
+   for i in range(args.ticks):
+      clock.strings(now)
+   tshared = (time.perf_counter() - t0)/args.ticks
+   print("computeTimes:          {:10.1f} us/tick".format(tastropy*1e6))
+   print("clock (new second):    {:10.1f} us/tick".format(tclock*1e6))
+   print("clock (same second):   {:10.1f} us/tick".format(tshared*1e6))
+
+   # Drift of the linear model just before it is re-anchored
+   errs = []
+   for dt in np.linspace(0, clock.refresh, 13):
+      ST = computeTimes(Time(now + dt, format='unix'))[2]
+      err = hms(clock.strings(now + dt)[2]) - hms(ST)
+      errs.append((err + 43200) % 86400 - 43200)
+   print("max ST difference over {:.0f} s: {} s".format(clock.refresh, 
+         np.abs(errs).max()))
@@ -0,0 +1,54 @@
+'''Benchmark the constellation lines' alt/az:  astroplan's Observer.altaz
+on both ends of every segment vs. one rotation matrix applied to the unique
+vertices (plot_skyview_bokeh.projectConLines)
+
+   python benchmarks/bench_conlines.py --repeat 100
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash import plot_skyview_bokeh as sky
+from magDash.compute import getObserver
+from magDash.skyoverlay import loadOverlay
+from astropy.time import Time
+
+def separation(zang1, az1, zang2, az2):
+   '''Angular distance (arcsec) between two positions (zenith angle in
+   degrees, azimuth in radians)'''
+   alt1,alt2 = np.radians(90 - zang1),np.radians(90 - zang2)
+   c = np.sin(alt1)*np.sin(alt2) + np.cos(alt1)*np.cos(alt2)*np.cos(az1-az2)
+   return np.degrees(np.arccos(np.clip(c, -1, 1)))*3600
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--repeat', type=int, default=100)
+   args = parser.parse_args()
+
+   obs = getObserver('LCO')
+   date = Time.now()
+   con = loadOverlay('conlines')
+   vecs,con1,con2 = sky.conSegments()
+   print("{} segments, {} unique vertices".format(len(con1), vecs.shape[1]))
+   t0 = time.perf_counter()
+   old = sky.RAhDecd2AltAz(obs, date, con['ra1'], con['dec1']) + \
+         sky.RAhDecd2AltAz(obs, date, con['ra2'], con['dec2'])
+   t1 = time.perf_counter()
+   sky.projectConLines(obs, date.unix)
+   t2 = time.perf_counter()
+   for i in range(args.repeat):
+      new = sky.projectConLines(obs, date.unix)
+   t3 = time.perf_counter()
+
+   err = np.concatenate([separation(*(old[:2] + new[:2])), 
+                         separation(*(old[2:] + new[2:]))])
+   up = np.concatenate([old[0], old[2]]) < 90
+   print("astropy:        {:10.2f} ms".format((t1-t0)*1000))
+   print("matrix (first): {:10.2f} ms".format((t2-t1)*1000))
+   print("matrix:         {:10.3f} ms".format((t3-t2)*1000/args.repeat))
+   print("max error:      {:10.1f} arcsec (above the horizon), "
+         "{:.1f} arcsec (all)".format(err[up].max(), err.max()))
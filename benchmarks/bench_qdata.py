@@ -0,0 +1,120 @@
+'''Benchmark query.qData against a local SQLite stand-in for the CSP database.
+
+Compares the per-target (N+1) priority/cadence queries with the set-based
+ones. An optional per-query latency models the round trip to csp-nas:
+
+   python benchmarks/bench_qdata.py --targets 300 --latency 2
+'''
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from magDash import query
+
+class Cursor:
+   '''Make a sqlite3 cursor look like a pymysql one (paramstyle, row counts)
+   and optionally add a fixed latency to each round trip.'''
+   def __init__(self, c, latency):
+      self.c = c
+      self.latency = latency
+      self.nquery = 0
+      self.rows = []
+
+   def execute(self, sql, args=()):
+      self.nquery += 1
+      if self.latency: time.sleep(self.latency)
+      self.c.execute(sql.replace('%s','?'), args)
+      self.rows = self.c.fetchall()
+      return len(self.rows)
+
+   def fetchall(self):
+      rows,self.rows = self.rows,[]
+      return rows
+
+   def fetchone(self):
+      return self.rows.pop(0) if self.rows else None
+
+class Connection:
+   def __init__(self, db, latency=0):
+      self.db = db
+      self.latency = latency
+      self.cursors = []
+
+   def cursor(self):
+      self.cursors.append(Cursor(self.db.cursor(), self.latency))
+      return self.cursors[-1]
+
+   def nquery(self):
+      return sum([c.nquery for c in self.cursors])
+
+   def close(self):
+      pass
+
+def seed(N, nphot=30, nlog=20, ncomm=5, rng=None):
+   '''Build an in-memory database with N active targets in every queue'''
+   if rng is None: rng = np.random.default_rng(1)
+   db = sqlite3.connect(':memory:')
+   c = db.cursor()
+   cols = query.Q_names[:-4]
+   c.execute('create table SNList ({})'.format(','.join(cols)))
+   c.execute('create table MAGSN (field,night,mag,jd,filt,obj)')
+   c.execute('create table obs_log (SN,MD,UT)')
+   c.execute('create table comments (sn_id,type,text,time)')
+   c.execute('create index magsn_field on MAGSN (field)')
+   c.execute('create index obs_sn on obs_log (SN,MD)')
+   c.execute('create index comm_id on comments (sn_id,type)')
+   RAs = np.sort(rng.uniform(0, 24, N))
+   priorities = ['Raw-high','High','Medium','Med-rare','Low','Monthly']
+   for i in range(N):
+      row = dict.fromkeys(cols, None)
+      name = 'SN2024{:04d}'.format(i)
+      row.update(SNID=i+1, SN=name, type='Ia', RA=float(RAs[i]),
+                 DE=float(rng.uniform(-80,20)), active='1', camp=int(rng.integers(1,30)),
+                 agerdate=float(2460300+rng.uniform(0,100)), qswo='1', qfire='1',
+                 qwfccd='1', name_csp=name, name_iau=name, name_psn=name)
+      c.execute('insert into SNList values ({})'.format(
+         ','.join(['?']*len(cols))), [row[k] for k in cols])
+      jds = 2460300 + rng.uniform(0, 100, nphot)
+      c.executemany('insert into MAGSN values (?,?,?,?,?,?)',
+         [(name, int(jd), float(rng.uniform(15,20)), float(jd), 'r', 0)
+          for jd in jds])
+      for MD in ['Opt','Spe','Isp']:
+         uts = ['2024-{:02d}-{:02d} 0{}:00:00'.format(rng.integers(1,13),
+                rng.integers(1,29), rng.integers(0,9)) for j in range(nlog)]
+         c.executemany('insert into obs_log values (?,?,?)',
+                       [(name, MD, ut) for ut in uts])
+      c.executemany('insert into comments values (?,?,?,?)',
+         [(i+1, 'priority', priorities[rng.integers(0,6)],
+           float(2460300+rng.uniform(0,100))) for j in range(ncomm)])
+   db.commit()
+   return db
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--targets', type=int, nargs='+', 
+                       default=[100,300,1000])
+   parser.add_argument('--latency', type=float, default=0.0,
+                       help='simulated round trip latency (ms)')
+   parser.add_argument('--queue', default='QSWO')
+   args = parser.parse_args()
+
+   print("{:>8s} {:>8s} {:>10s} {:>8s} {:>10s} {:>8s}".format(
+      'targets','queries','N+1 (s)','queries','batch (s)','speedup'))
+   for N in args.targets:
+      db = seed(N)
+      res = []
+      for batched in [False, True]:
+         conn = Connection(db, args.latency/1000)
+         t0 = time.perf_counter()
+         data = query.qData(args.queue, db=conn, batched=batched)
+         res.append((conn.nquery(), time.perf_counter() - t0, data))
+      assert np.array_equal(res[0][2]['priority'], res[1][2]['priority'])
+      if args.queue != 'QFIRE':
+         # the per-target path looks up QFIRE cadences under MD="Opt"
+         assert np.allclose(res[0][2]['jdcad'], res[1][2]['jdcad'])
+      print("{:8d} {:8d} {:10.3f} {:8d} {:10.3f} {:8.1f}".format(N,
+         res[0][0], res[0][1], res[1][0], res[1][1], res[0][1]/res[1][1]))
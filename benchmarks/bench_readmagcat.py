@@ -0,0 +1,52 @@
+'''Benchmark data.readMagCat on synthetic Magellan catalogs of increasing size
+
+   python benchmarks/bench_readmagcat.py --sizes 100 1000 10000
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.data import readMagCat
+
+def sexagesimal(x, sign=False):
+   s = '-' if x < 0 else ('+' if sign else '')
+   x = abs(x)
+   d = int(x);  m = int((x-d)*60);  sec = min((x-d-m/60)*3600, 59.9)
+   return "{}{:02d}:{:02d}:{:04.1f}".format(s, d, m, sec)
+
+def makeCatalog(N, rng=None):
+   '''A catalog with a mix of full, short and commented lines'''
+   if rng is None: rng = np.random.default_rng(1)
+   lines = ['# ID Name RA DEC equinox ...']
+   for i in range(N):
+      fs = ["{:03d}".format(i), "target{}".format(i), 
+            sexagesimal(rng.uniform(0,24)), 
+            sexagesimal(rng.uniform(-90,30), sign=True), "2000.0", "0.0",
+            "0.0", "0.0", "EQU", "0", "0", "2000.0", "0", "0", "2000.0",
+            "2024.5"]
+      fs = fs[:[16,15,4][i % 3]]
+      if i % 5 == 0: fs.append('# priority target #{}'.format(i))
+      lines.append(" ".join(fs))
+   return "\n".join(lines).encode('utf-8')
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--sizes', type=int, nargs='+',
+                       default=[100,1000,10000])
+   parser.add_argument('--repeat', type=int, default=5)
+   args = parser.parse_args()
+
+   print("{:>8s} {:>10s} {:>12s}".format('targets', 'time (ms)', 'us/target'))
+   for N in args.sizes:
+      cat = makeCatalog(N)
+      best = np.inf
+      for i in range(args.repeat):
+         t0 = time.perf_counter()
+         data = readMagCat(cat)
+         best = min(best, time.perf_counter() - t0)
+      assert data['N'] == N
+      print("{:8d} {:10.2f} {:12.2f}".format(N, best*1000, best*1e6/N))
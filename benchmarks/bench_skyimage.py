@@ -0,0 +1,76 @@
+'''Benchmark decoding the all-sky image for Bokeh:  the old per-pixel
+getdata() decode vs. query.decodeSky at full and plot resolution, with the
+bytes sent per frame
+
+   python benchmarks/bench_skyimage.py --sizes 1000 2000 --plot 500
+'''
+import os
+import sys
+import io
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from magDash import query
+
+def decodeGetdata(im):
+   '''The old decode (square RGBA images only)'''
+   arr = np.array(im.getdata()).reshape(im.size[0],im.size[1],4)
+   img = np.empty((im.size[0],im.size[1]), dtype=np.uint32)
+   view = img.view(dtype=np.uint8).reshape((im.size[0],im.size[1],4))
+   for i in range(4):
+      view[:,:,i] = arr[::-1,::,i]
+   return img
+
+def makeImage(size, format, rng=None):
+   '''A smooth synthetic sky (so JPEG/PNG compress realistically)'''
+   if rng is None: rng = np.random.default_rng(1)
+   y,x = np.mgrid[0:size,0:size]/size
+   arr = np.zeros((size,size,4), dtype=np.uint8)
+   for i in range(3):
+      arr[:,:,i] = 127*(1 + np.sin(10*x*(i+1) + 7*y)) + \
+                   rng.integers(0, 2, (size,size))
+   arr[:,:,3] = 255
+   mode = 'RGBA' if format == 'PNG' else 'RGB'
+   buf = io.BytesIO()
+   Image.fromarray(arr[:,:,:len(mode)], mode).save(buf, format=format)
+   return buf.getvalue()
+
+def best(func, content, repeat):
+   t = np.inf
+   for i in range(repeat):
+      t0 = time.perf_counter()
+      img = func(Image.open(io.BytesIO(content)))
+      t = min(t, time.perf_counter() - t0)
+   return t,img
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--sizes', type=int, nargs='+', default=[1000,2000])
+   parser.add_argument('--plot', type=int, default=query.SKY_SIZE,
+                       help='plot resolution (pixels)')
+   parser.add_argument('--repeat', type=int, default=3)
+   args = parser.parse_args()
+
+   print("{:>6s} {:>5s} {:>16s} {:>16s} {:>16s}".format('size', 'fmt',
+      'getdata ms/MB', 'full ms/MB', 'plot ms/MB'))
+   for size in args.sizes:
+      for format in ['PNG','JPEG']:
+         content = makeImage(size, format)
+         res = []
+         if format == 'PNG':
+            res.append(best(decodeGetdata, content, args.repeat))
+         else:
+            res.append((np.nan, None))      # needs a 4-channel image
+         res.append(best(lambda im: query.decodeSky(im, size=0), content,
+                         args.repeat))
+         res.append(best(lambda im: query.decodeSky(im, size=args.plot),
+                         content, args.repeat))
+         if res[0][1] is not None:
+            assert np.array_equal(res[0][1], res[1][1])
+         print("{:6d} {:>5s} ".format(size, format)+" ".join(
+            ["{:8.1f}/{:<7.2f}".format(t*1000, 
+               img.nbytes/2**20 if img is not None else np.nan)
+             for t,img in res]))
@@ -0,0 +1,67 @@
+'''Benchmark the bright-star overlay:  projecting every star of the catalog
+vs. the tier slice and cone cut of skyoverlay.StarIndex.query for the stars
+in view, for views of decreasing size. "query" is the selection and 
+projection alone, "setStars" includes sending the stars to the source.
+
+   python benchmarks/bench_stars.py --repeat 200
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.skyoverlay import starIndex, STAR_TIERS
+from magDash.plot_skyview_bokeh import SkyMap, conMatrix, STAR_ZOOM
+
+def viewMaglim(radius):
+   '''The faintest tier SkyMap.setStars shows in a view of radius'''
+   for r,mag in STAR_ZOOM:
+      if radius <= r:
+         return mag
+   return STAR_TIERS[0]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--repeat', type=int, default=200)
+   args = parser.parse_args()
+
+   sky = SkyMap()
+   sky.stars()
+   index = starIndex()
+   unix = time.time()
+   print("{} stars in the catalog".format(index.vecs.shape[1]))
+
+   M = conMatrix(sky.obs, unix)
+   t0 = time.perf_counter()
+   for i in range(args.repeat):
+      n,e,u = M @ index.vecs
+      up = u > 0
+      alt,az = np.degrees(np.arcsin(u[up])),np.arctan2(e[up], n[up])
+   t1 = time.perf_counter()
+   print("all stars:     {:8.3f} ms  {:5d} above the horizon".format(
+         (t1-t0)*1000/args.repeat, np.sum(up)))
+
+   print("{:>24s} {:>8s} {:>8s} {:>8s} {:>9s}".format('view', 'radius', 
+         'stars', 'query ms', 'setStars'))
+   for half in (1.1, 0.7, 0.5, 0.3, 0.1):
+      view = (0.2-half, 0.2+half, -half, half)
+      sky.setStars(unix, view)
+      center,radius = sky.viewCap(view)
+      maglim = viewMaglim(radius)
+      M = conMatrix(sky.obs, unix)
+      t0 = time.perf_counter()
+      for i in range(args.repeat):
+         idx = index.query(M.T @ center, np.radians(radius), maglim)
+         n,e,u = M @ index.vecs[:,idx]
+         up = u > 0
+      t1 = time.perf_counter()
+      for i in range(args.repeat):
+         sky.setStars(unix, view)
+      t2 = time.perf_counter()
+      print("{:>24s} {:8.0f} {:8d} {:8.3f} {:9.3f}".format(
+            "({:.1f},{:.1f},{:.1f},{:.1f})".format(*view), radius, 
+            len(sky.starCDS.data['zang']), (t1-t0)*1000/args.repeat,
+            (t2-t1)*1000/args.repeat))
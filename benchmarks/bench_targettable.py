@@ -0,0 +1,104 @@
+'''Benchmark adding the standards and deriving the observe/color columns on a
+large synthetic queue: dict of lists (per-key list.insert, Python loops)
+vs. TargetTable (one sorted merge, vectorized columns)
+
+   python benchmarks/bench_targettable.py --targets 1000 10000 50000
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.targettable import TargetTable
+from magDash.OptStandards import raw, addStandards
+from magDash.data import ObjectData
+
+NCOLS = 40    # about the number of columns of a POISE queue
+
+def makeQueue(N, rng=None):
+   if rng is None: rng = np.random.default_rng(1)
+   priorities = np.array(ObjectData.PRIORITY_OPTIONS[:-3])
+   data = dict(RA=np.sort(rng.uniform(0, 24, N)), DE=rng.uniform(-80, 20, N),
+               ID=np.arange(1,N+1).astype(str),
+               Name=np.char.mod('SN2024%05d', np.arange(N)),
+               comm=np.full(N, 'Ia'),
+               priority=priorities[rng.integers(0, len(priorities), N)],
+               cad=rng.uniform(0, 10, N))
+   for i in range(NCOLS - len(data)):
+      data['x{}'.format(i)] = rng.uniform(0, 1, N)
+   return data
+
+def addStandardsLists(data, queue):
+   '''The dict-of-lists version of OptStandards.addStandards'''
+   for (id,name,ra,dec) in raw[queue]:
+      coord = SkyCoord(ra,dec, unit=(u.hourangle, u.degree))
+      RA = coord.ra.to('hourangle').value
+      DE = coord.dec.to('degree').value
+      idx = np.searchsorted(data['RA'], RA)
+      for key in data:
+         if key == 'RA':
+            data[key].insert(idx, RA)
+         elif key == 'DE':
+            data[key].insert(idx, DE)
+         elif key == 'ID':
+            data[key].insert(idx,id)
+         elif key == "Name":
+            data[key].insert(idx, name)
+         elif key in ["comm","priority"]:
+            data[key].insert(idx,"Standard")
+         else:
+            data[key].insert(idx,data[key][-1]*0)
+
+def derivedLists(data):
+   observe = []
+   for c,p in zip(data['cad'], data['priority']):
+      if c and p in ObjectData.cadences:
+         observe.append('Y' if c >= ObjectData.cadences[p] else 'N')
+      else:
+         observe.append('-')
+   color = ["orange" if t.find('Standard') >= 0 else "blue"
+            for t in data['comm']]
+   return observe,color
+
+def derivedTable(data):
+   observe = ObjectData.observeFlags(ObjectData, data['cad'],
+                                     data['priority'])
+   color = np.where(np.char.find(data['comm'], 'Standard') >= 0,
+                    "orange", "blue")
+   return observe,color
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--targets', type=int, nargs='+',
+                       default=[1000,10000,50000])
+   parser.add_argument('--queue', default='QSWO')
+   args = parser.parse_args()
+
+   print("{:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s}".format('targets',
+      'lists (s)', 'derived', 'table (s)', 'derived', 'speedup'))
+   for N in args.targets:
+      queue = makeQueue(N)
+      lists = dict([(key,list(value)) for key,value in queue.items()])
+      t0 = time.perf_counter()
+      addStandardsLists(lists, args.queue)
+      t1 = time.perf_counter()
+      old = derivedLists(lists)
+      t2 = time.perf_counter()
+
+      table = TargetTable(queue)
+      t3 = time.perf_counter()
+      addStandards(table, args.queue)
+      t4 = time.perf_counter()
+      new = derivedTable(table)
+      t5 = time.perf_counter()
+
+      assert np.allclose(lists['RA'], table['RA'])
+      assert list(lists['Name']) == list(table['Name'])
+      assert list(old[0]) == list(new[0]) and list(old[1]) == list(new[1])
+      print("{:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f} {:8.1f}".format(N,
+         t1-t0, t2-t1, t4-t3, t5-t4, (t2-t0)/(t5-t3)))
@@ -0,0 +1,57 @@
+'''Document size and serialization time of the airmass plot with a per-target
+copy of the time axis (the old layout) versus one shared time axis.
+
+   python benchmarks/bench_timeaxis.py --sizes 100 1000
+'''
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.data import timeAxisJS
+from bokeh.document import Document
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, CustomJSTransform
+from bokeh.transform import transform
+
+def makeDoc(alts, dts, shared):
+   fig = figure(x_axis_type='datetime')
+   if shared:
+      axis = ColumnDataSource(dict(t=np.asarray(dts, dtype='datetime64[ms]').\
+                                   astype(np.float64)))
+      source = ColumnDataSource(dict(alts=list(alts)))
+      xs = transform('alts', CustomJSTransform(args=dict(axis=axis),
+                                               v_func=timeAxisJS))
+   else:
+      source = ColumnDataSource(dict(alts=list(alts), 
+                                     times=[dts for x in alts]))
+      xs = 'times'
+   fig.multi_line(xs=xs, ys='alts', source=source)
+   doc = Document()
+   doc.add_root(fig)
+   return doc
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--sizes', type=int, nargs='+', default=[100,1000])
+   parser.add_argument('--ntimes', type=int, default=170)
+   args = parser.parse_args()
+
+   t0 = datetime.datetime(2024, 1, 1, 23)
+   dts = [t0 + datetime.timedelta(minutes=5*i) for i in range(args.ntimes)]
+   print("{:>8s} {:>16s} {:>10s} {:>16s} {:>10s}".format('targets',
+         'per-target (B)', 'time (s)', 'shared (B)', 'time (s)'))
+   for N in args.sizes:
+      alts = np.random.uniform(0, 90, (N, args.ntimes))
+      res = []
+      for shared in [False, True]:
+         doc = makeDoc(alts, dts, shared)
+         t = time.perf_counter()
+         size = len(json.dumps(doc.to_json(deferred=False)))
+         res += [size, time.perf_counter() - t]
+      print("{:8d} {:16d} {:10.3f} {:16d} {:10.3f}".format(N, *res))
@@ -0,0 +1,51 @@
+'''Regression checks of the NumPy alt/az engine (compute.fastAltAz and
+fastTransit) against astroplan's Observer.altaz and 
+target_meridian_transit_time. See checks.py.
+
+   python benchmarks/check_altaz.py [fastAltAz] [fastTransit]
+'''
+import argparse
+import numpy as np
+
+from checks import DATES, observer, separation, catalog, run
+from magDash import compute
+from astroplan import FixedTarget
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+from astropy import units as u
+
+def test_fastAltAz(tol=60):
+   '''fastAltAz vs. Observer.altaz over a whole night grid (arcsec)'''
+   obs = observer()
+   RA,DE = catalog()
+   targets = FixedTarget(SkyCoord(RA*u.hourangle, DE*u.deg))
+   worst = 0
+   for date in DATES:
+      times = compute.makeTimeRange(Time(date))['times']
+      alt,az = compute.fastAltAz(RA, DE, times)
+      ref = obs.altaz(times, targets, grid_times_targets=True)
+      err = separation(alt, az, ref.alt.deg, ref.az.deg)
+      worst = max(worst, err.max())
+   print("fastAltAz vs Observer.altaz:    max {:6.1f} arcsec".format(worst))
+   assert worst < tol
+
+def test_fastTransit(tol=5):
+   '''fastTransit vs. Observer.target_meridian_transit_time (minutes)'''
+   obs = observer()
+   RA,DE = catalog(20)
+   targets = FixedTarget(SkyCoord(RA*u.hourangle, DE*u.deg))
+   worst = 0
+   for date in DATES:
+      date = Time(date)
+      fast = compute.fastTransit(RA, DE, date)
+      ref = obs.target_meridian_transit_time(date, targets, which='nearest')
+      worst = max(worst, np.absolute((fast - ref).to('min').value).max())
+   print("fastTransit vs astroplan:       max {:6.2f} min".format(worst))
+   assert worst < tol
+
+CHECKS = [test_fastAltAz, test_fastTransit]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('checks', nargs='*', help='run only these')
+   run(CHECKS, parser.parse_args().checks)
@@ -0,0 +1,38 @@
+'''Regression check of plot_skyview_bokeh.projectConLines (one rotation
+matrix for all the constellation vertices) against astroplan's 
+Observer.altaz of both ends of every segment. See checks.py.
+
+   python benchmarks/check_conlines.py
+'''
+import argparse
+import numpy as np
+
+from checks import DATES, observer, separation, run
+from magDash import plot_skyview_bokeh as sky
+from magDash.skyoverlay import loadOverlay
+from astropy.time import Time
+
+def test_projectConLines(tol=60):
+   '''projectConLines vs. Observer.altaz of both ends of every segment
+   (the old RAhDecd2AltAz)'''
+   obs = observer()
+   con = loadOverlay('conlines')
+   worst = 0
+   for date in DATES:
+      date = Time(date)
+      ref = sky.RAhDecd2AltAz(obs, date, con['ra1'], con['dec1']) + \
+            sky.RAhDecd2AltAz(obs, date, con['ra2'], con['dec2'])
+      new = sky.projectConLines(obs, date.unix)
+      for i in (0,2):
+         err = separation(90 - ref[i], np.degrees(ref[i+1]),
+                          90 - new[i], np.degrees(new[i+1]))
+         worst = max(worst, err.max())
+   print("projectConLines vs astroplan:   max {:6.1f} arcsec".format(worst))
+   assert worst < tol
+
+CHECKS = [test_projectConLines]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('checks', nargs='*', help='run only these')
+   run(CHECKS, parser.parse_args().checks)
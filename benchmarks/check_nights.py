@@ -0,0 +1,50 @@
+'''Regression check of compute.NightCalendar (nightOf and night) against
+the astroplan sunset/twilight/sunrise searches makeTimeRange() used to do
+for every call. See checks.py.
+
+   python benchmarks/check_nights.py
+'''
+import argparse
+import numpy as np
+
+from checks import DATES, observer, run
+from magDash import compute
+from astropy.time import Time
+from astropy import units as u
+
+def astroplanNight(date, location='LCO'):
+   '''The night makeTimeRange() used to compute with astroplan directly'''
+   obs = observer(location)
+   sunset = obs.sun_set_time(date, which="previous")
+   sunrise = obs.sun_rise_time(date, which="next")
+   if sunrise.jd - sunset.jd > 1:
+      sunset = obs.sun_set_time(date, which="next")
+   twilight_end = obs.twilight_evening_astronomical(sunset, which="next")
+   twilight_begin = obs.twilight_morning_astronomical(twilight_end,
+           which="next")
+   sunrise = obs.sun_rise_time(twilight_begin, which="next")
+   return dict(ss=sunset, te=twilight_end, tb=twilight_begin, sr=sunrise)
+
+def test_nightOf(tol=1):
+   '''NightCalendar.night() vs. astroplanNight(), every 90 minutes for two
+   days around each date (minutes)'''
+   observer()
+   worst = 0
+   for date in DATES:
+      for dt in np.arange(-24, 24, 1.5):
+         date1 = Time(date) + dt*u.hour
+         new = compute.calendar.night(date1)
+         ref = astroplanNight(date1)
+         assert new['night'] == compute.calendar.nightOf(date1)
+         assert date1 < new['sr'], date1
+         for key in compute.NightCalendar.EVENTS:
+            worst = max(worst, abs((new[key] - ref[key]).to('min').value))
+   print("NightCalendar vs astroplan:     max {:6.3f} min".format(worst))
+   assert worst < tol
+
+CHECKS = [test_nightOf]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('checks', nargs='*', help='run only these')
+   run(CHECKS, parser.parse_args().checks)
@@ -0,0 +1,77 @@
+'''Regression checks of the patch-based source updates (data.ObjectData's
+changedRows and flushColumns), on a stand-in for ObjectData that has only
+the source. See checks.py.
+
+   python benchmarks/check_patch.py [changedRows] [flushColumns]
+'''
+import types
+import argparse
+import numpy as np
+
+from checks import run
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource, DataTable
+from magDash.data import ObjectData
+
+def standIn(data):
+   '''Just enough of an ObjectData for changedRows and flushColumns'''
+   od = types.SimpleNamespace(PATCH_TOL=ObjectData.PATCH_TOL,
+         PATCH_FRAC=ObjectData.PATCH_FRAC, source=ColumnDataSource(data),
+         pending={}, flushing=False, lastPush=0)
+   od.changedRows = lambda key,new: ObjectData.changedRows(od, key, new)
+   od.flushColumns = lambda: ObjectData.flushColumns(od)
+   return od
+
+def test_changedRows():
+   '''Only the rows that changed by more than PATCH_TOL; None when the
+   column is new or changes length'''
+   tol = ObjectData.PATCH_TOL['AM']
+   AM = np.linspace(1, 2, 10)
+   od = standIn(dict(AM=AM.copy(), Name=list('abcdefghij'), mag=AM.copy()))
+
+   new = AM.copy()
+   new[2] += 0.5*tol
+   new[5] += 2*tol
+   new[7] = np.nan
+   assert list(od.changedRows('AM', new)) == [5, 7]
+   od.source.data['AM'][7] = np.nan
+   assert list(od.changedRows('AM', new)) == [5]
+   # no tolerance for other columns
+   new = AM.copy()
+   new[3] += 1e-9
+   assert list(od.changedRows('mag', new)) == [3]
+   assert list(od.changedRows('mag', AM.copy())) == []
+   names = list('abcdefghij')
+   names[4] = 'x'
+   assert list(od.changedRows('Name', names)) == [4]
+   assert od.changedRows('AM', AM[:5]) is None
+   assert od.changedRows('HA', AM) is None
+   print("changedRows:                    ok")
+
+def test_flushColumns():
+   '''Queued columns go out as one patch event: a slice where most rows
+   changed, single cells otherwise, nothing for unchanged columns'''
+   HA = np.linspace(-3, 3, 10)
+   od = standIn(dict(HA=HA.copy(), alt=HA.copy(), Tags=['']*10))
+   doc = Document()
+   doc.add_root(DataTable(source=od.source))
+   events = []
+   doc.on_change(events.append)
+
+   od.pending = dict(HA=HA + 1, alt=HA.copy(), Tags=['a']+['']*8+['Cadence3'])
+   od.flushColumns()
+   assert len(events) == 1 and od.pending == {}
+   patches = events[0].patches
+   assert sorted(patches) == ['HA', 'Tags']
+   assert [type(i) for i,v in patches['HA']] == [slice]
+   assert [i for i,v in patches['Tags']] == [0, 9]
+   assert np.allclose(od.source.data['HA'], HA + 1)
+   assert od.source.data['Tags'][9] == 'Cadence3'
+   print("flushColumns:                   ok")
+
+CHECKS = [test_changedRows, test_flushColumns]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('checks', nargs='*', help='run only these')
+   run(CHECKS, parser.parse_args().checks)
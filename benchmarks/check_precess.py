@@ -0,0 +1,35 @@
+'''Regression check of compute.precessToDate (the coordinates of date the
+browser uses in client mode) against astropy's TETE frame. See checks.py.
+
+   python benchmarks/check_precess.py
+'''
+import argparse
+
+from checks import DATES, catalog, run
+from magDash import compute
+from astropy.coordinates import SkyCoord, TETE
+from astropy.time import Time
+from astropy import units as u
+
+def test_precessToDate(tol=25):
+   '''Equator of date vs. astropy's TETE. TETE is apparent (it includes
+   annual aberration, < 20.5 arcsec), precessToDate isn't.'''
+   RA,DE = catalog()
+   worst = 0
+   for date in DATES:
+      date = Time(date)
+      ra,de = compute.precessToDate(RA, DE, date)
+      ref = SkyCoord(RA*u.hourangle, DE*u.deg).transform_to(
+            TETE(obstime=date))
+      new = SkyCoord(ra*u.hourangle, de*u.deg, frame=TETE(obstime=date))
+      err = new.separation(ref).arcsec
+      worst = max(worst, err.max())
+   print("precessToDate vs TETE:          max {:6.1f} arcsec".format(worst))
+   assert worst < tol
+
+CHECKS = [test_precessToDate]
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('checks', nargs='*', help='run only these')
+   run(CHECKS, parser.parse_args().checks)
@@ -0,0 +1,60 @@
+'''Shared pieces of the check_*.py regression checks. Each check compares a
+fast path against the astropy/astroplan result it replaced, asserts a
+tolerance and prints the worst error. They run as scripts or under pytest
+(python -m pytest benchmarks/check_*.py). Checks that need astroplan's
+site registry are skipped if it can't be reached.'''
+import os
+import sys
+import numpy as np
+
+here = os.path.dirname(__file__)
+sys.path[:0] = [os.path.join(here, '..'), os.path.join(here, '..', 'magDash')]
+from magDash.compute import getObserver
+try:
+   import pytest
+except ImportError:
+   pytest = None
+
+# Some nights across the year (UT of local evening, mid-night and morning)
+DATES = ['2024-03-20T23:00', '2024-06-21T04:00', '2024-09-22T10:30',
+         '2024-12-21T12:00', '2025-05-01T16:00']
+
+class Skipped(Exception):
+   pass
+
+def skip(msg):
+   if pytest is not None:
+      pytest.skip(msg)
+   raise Skipped(msg)
+
+def observer(location='LCO'):
+   '''getObserver(location), or skip the check if the site registry can't
+   be reached (Observer.at_site downloads it)'''
+   try:
+      return getObserver(location)
+   except OSError as e:
+      skip("site registry unavailable, {}".format(type(e).__name__))
+
+def separation(alt1, az1, alt2, az2):
+   '''Angular distance (arcsec) between two alt/az positions (degrees)'''
+   alt1,az1,alt2,az2 = [np.radians(x) for x in (alt1,az1,alt2,az2)]
+   c = np.sin(alt1)*np.sin(alt2) + np.cos(alt1)*np.cos(alt2)*np.cos(az1-az2)
+   return np.degrees(np.arccos(np.clip(c, -1, 1)))*3600
+
+def catalog(N=200, seed=1):
+   '''N random targets (RA in hours, DE in degrees) over the whole sky'''
+   rng = np.random.default_rng(seed)
+   RA = rng.uniform(0, 24, N)
+   DE = np.degrees(np.arcsin(rng.uniform(-1, 1, N)))
+   return RA,DE
+
+def run(checks, names=None):
+   '''Run the checks (all, or those named, without the test_ prefix)'''
+   skipped = (Skipped,) if pytest is None else (Skipped, pytest.skip.Exception)
+   for check in checks:
+      if names and check.__name__[5:] not in names:
+         continue
+      try:
+         check()
+      except skipped as e:
+         print("{:32s}skipped ({})".format(check.__name__[5:]+':', e))
@@ -0,0 +1,123 @@
+'''Functional smoke check (not a timing benchmark) of query.SkyFetcher
+against a local stand-in for the LCO weather server, which serves a
+synthetic all-sky PNG with ETag/Last-Modified and an optional delay. Asserts
+that 304s keep the frame, new images replace it, and that timeouts and a
+dead server keep the last good frame. The frames are kept in a small ring
+(skyring.FrameRing) in a temporary directory.
+
+   python benchmarks/smoke_skyfetch.py --size 1000 --delay 3 --timeout 1
+'''
+import os
+import sys
+import io
+import time
+import argparse
+import tempfile
+import threading
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from magDash import query
+from magDash.skyring import FrameRing
+
+class StandIn(BaseHTTPRequestHandler):
+   '''Serves server.image (PNG bytes), honouring If-None-Match and 
+   If-Modified-Since, after sleeping server.delay seconds'''
+   def do_GET(self):
+      time.sleep(self.server.delay)
+      self.server.requests += 1
+      etag = '"{}"'.format(self.server.version)
+      if self.headers.get('If-None-Match') == etag:
+         self.send_response(304)
+         self.end_headers()
+         return
+      self.send_response(200)
+      self.send_header('Content-Type', 'image/png')
+      self.send_header('Content-Length', str(len(self.server.image)))
+      self.send_header('ETag', etag)
+      self.send_header('Last-Modified', formatdate(self.server.mtime, 
+                                                   usegmt=True))
+      self.end_headers()
+      self.wfile.write(self.server.image)
+
+   def log_message(self, *args):
+      pass
+
+def makePNG(size, seed=1):
+   rng = np.random.default_rng(seed)
+   arr = rng.integers(0, 256, (size,size,4), dtype=np.uint8)
+   buf = io.BytesIO()
+   Image.fromarray(arr, 'RGBA').save(buf, format='PNG')
+   return buf.getvalue()
+
+def serve(size):
+   server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+   server.image = makePNG(size)
+   server.version = 1
+   server.mtime = time.time() - 120
+   server.delay = 0
+   server.requests = 0
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server
+
+def timed(fetcher, **kw):
+   t0 = time.perf_counter()
+   sky = fetcher.latest(**kw)
+   return time.perf_counter() - t0, sky
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+   parser.add_argument('--size', type=int, default=1000)
+   parser.add_argument('--delay', type=float, default=3,
+                       help='delay (s) of the slow server')
+   parser.add_argument('--timeout', type=float, default=1,
+                       help='SkyFetcher request timeout (s)')
+   args = parser.parse_args()
+
+   server = serve(args.size)
+   url = 'http://127.0.0.1:{}/latestimage.png'.format(server.server_port)
+   static = tempfile.mkdtemp()
+   ring = FrameRing(static, 10, static=static)
+   fetcher = query.SkyFetcher(url, timeout=args.timeout, ttl=0, size=0,
+                              ring=ring)
+
+   dt,sky = timed(fetcher, wait=30, force=True)
+   assert sky['image'] is not None and sky['image'].shape == (args.size,)*2+(3,)
+   print("first fetch (200):      {:8.3f}s  age {:.0f}s".format(dt, 
+         sky['age']))
+   frame,version = sky['image'],sky['frames']['version'][-1]
+   jpeg = sky['frames']['file'][-1]
+   print("   bytes per frame:  {:.0f}kB as RGB, {:.0f}kB as {}".format(
+         frame.nbytes/1024, os.path.getsize(os.path.join(static, jpeg))/1024,
+         jpeg))
+   dt,sky = timed(fetcher, wait=30, force=True)
+   assert sky['image'] is frame and sky['error'] is None
+   assert sky['frames']['version'] == [version]
+   print("unchanged (304):        {:8.3f}s".format(dt))
+   server.version += 1
+   server.image = makePNG(args.size, server.version)
+   server.mtime = time.time()
+   dt,sky = timed(fetcher, wait=30, force=True)
+   assert sky['image'] is not frame
+   assert sky['frames']['version'][-1] != version
+   print("new frame (200):        {:8.3f}s  age {:.0f}s".format(dt, 
+         sky['age']))
+   frame = sky['image']
+
+   server.delay = args.delay
+   dt,sky = timed(fetcher, wait=0, force=True)
+   print("slow server, no wait:   {:8.3f}s".format(dt))
+   dt,sky = timed(fetcher, wait=2*args.delay, force=True)
+   assert sky['image'] is frame and sky['error'] is not None
+   print("slow server, timed out: {:8.3f}s  last good frame kept ({})".format(
+         dt, sky['error'][:40]))
+   server.shutdown()
+   server.server_close()
+   dt,sky = timed(fetcher, wait=30, force=True)
+   assert sky['image'] is frame and sky['error'] is not None
+   print("server down:            {:8.3f}s  last good frame kept".format(dt))
+   print("requests served: {}, frames in the ring: {}".format(
+         server.requests, len(ring)))
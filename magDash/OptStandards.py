@@ -2,7 +2,6 @@
 
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-from datetime import date
 import numpy as np
 
 raw = {'QWFCCD':[
@@ -80,33 +79,13 @@ raw = {'QWFCCD':[
 ]}
 
 def addStandards(data, queue='QFCCD'):
-   '''Add standards to the data dictionary. Optionally takes 'inst'
-   as instrument nae'''
-   for (id,name,ra,dec) in raw[queue]:
-      coord = SkyCoord(ra,dec, unit=(u.hourangle, u.degree))
-      RA = coord.ra.to('hourangle').value
-      DE = coord.dec.to('degree').value
-      idx = np.searchsorted(data['RA'], RA)
-
-      for key in data:
-         if key == 'RA':
-            data[key].insert(idx, RA)
-         elif key == 'DE':
-            data[key].insert(idx, DE)
-         elif key == 'ID':
-            data[key].insert(idx,id)
-         elif key == "Name":
-            data[key].insert(idx, name)
-         elif key == "comm":
-            data[key].insert(idx,"Standard")
-         elif key == "priority":
-             data[key].insert(idx, "Standard")
-         else:
-            if data[key][-1] is None:
-               data[key].insert(idx, None)
-            elif isinstance(data[key][-1], date):
-               data[key].insert(idx,date(2024,1,1))
-            else:
-               data[key].insert(idx,data[key][-1]*0)
-
-
+   '''Add standards to the data (a TargetTable sorted by RA), keeping it
+   sorted. Optionally takes 'inst' as instrument nae'''
+   ids,names,ras,decs = zip(*raw[queue])
+   coord = SkyCoord(list(ras), list(decs), unit=(u.hourangle, u.degree))
+   N = len(ids)
+   data.merge(dict(RA=coord.ra.to('hourangle').value,
+                   DE=coord.dec.to('degree').value,
+                   ID=np.array(ids), Name=np.array(names),
+                   comm=np.full(N, "Standard"),
+                   priority=np.full(N, "Standard")))
@@ -0,0 +1,128 @@
+'''catcache.py:  cache of parsed Magellan catalogs and their night tracks.
+
+Entries are keyed by the SHA1 of the uploaded file and the observing night
+(the one compute.makeTimeRange picks), kept in memory with LRU eviction and,
+optionally, in a directory of .npz files so they survive restarts (set
+MAGDASH_CATCACHE to the directory).'''
+
+import os
+import copy
+import hashlib
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+import numpy as np
+from astropy.time import Time
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+from astroplan import FixedTarget
+from .targettable import TargetTable
+
+# Keys that are cheaply re-derived when loading from disk
+DERIVED = ['targets','t0','t1']
+
+def toArrays(data):
+   '''Convert the output of computeNightQuantities to a dict of plain 
+   arrays suitable for np.savez. Returns None if that isn't possible.'''
+   arrays = {}
+   if hasattr(data, 'columns'):
+      arrays['columns:'] = np.array(data.columns, dtype=str)
+   for key,value in data.items():
+      if key in DERIVED: continue
+      if isinstance(value, Time):
+         prefix = 'time:' if value.isscalar else 'times:'
+         arrays[prefix+key] = np.asarray(value.utc.jd)
+      elif isinstance(value, list) and len(value) and \
+            isinstance(value[0], Time):
+         arrays['times:'+key] = np.array([t.utc.jd for t in value])
+      else:
+         value = np.asarray(value)
+         if value.dtype == object:
+            return None
+         arrays[key] = value
+   return arrays
+
+def fromArrays(arrays):
+   '''Inverse of toArrays()'''
+   data = TargetTable()
+   if 'columns:' in arrays:
+      data.columns = arrays['columns:'].tolist()
+   for key in arrays:
+      value = arrays[key]
+      if key == 'columns:':
+         continue
+      elif key.startswith('time:') or key.startswith('times:'):
+         data[key.split(':')[1]] = Time(value, format='jd', scale='utc')
+      elif value.ndim == 0:
+         data[key] = value.item()
+      else:
+         data[key] = value
+   data['targets'] = FixedTarget(SkyCoord(data['RA'], data['DE'], 
+                                          unit=(u.hourangle, u.degree)))
+   data['t0'] = data['times'][0].datetime
+   data['t1'] = data['times'][-1].datetime
+   return data
+
+class CatalogCache:
+   '''LRU cache of computed catalogs with an optional on-disk store.
+
+   Args:
+      maxsize(int):  maximum number of entries held in memory
+      path(str):  directory for .npz copies of the entries (None: memory
+                  only)'''
+
+   def __init__(self, maxsize=16, path=None):
+      self.maxsize = maxsize
+      self.path = path
+      self.entries = OrderedDict()
+      self.lock = threading.Lock()
+      if path is not None:
+         os.makedirs(path, exist_ok=True)
+
+   def key(self, content, night):
+      '''Cache key for the raw catalog content on a given night'''
+      return "{}_{}".format(hashlib.sha1(content).hexdigest(), night)
+
+   def _file(self, key):
+      return os.path.join(self.path, key+'.npz')
+
+   def get(self, key):
+      '''Return a (shallow) copy of the cached data or None'''
+      with self.lock:
+         if key in self.entries:
+            self.entries.move_to_end(key)
+            return copy.copy(self.entries[key])
+      if self.path is None or not os.path.isfile(self._file(key)):
+         return None
+      try:
+         with np.load(self._file(key)) as f:
+            data = fromArrays(dict(f))
+      except Exception:
+         print(traceback.format_exc())
+         return None
+      self._remember(key, data)
+      return copy.copy(data)
+
+   def put(self, key, data):
+      self._remember(key, copy.copy(data))
+      if self.path is None: return
+      arrays = toArrays(data)
+      if arrays is None: return
+      fd,tmp = tempfile.mkstemp(dir=self.path, suffix='.npz')
+      with os.fdopen(fd, 'wb') as f:
+         np.savez(f, **arrays)
+      os.replace(tmp, self._file(key))
+
+   def _remember(self, key, data):
+      with self.lock:
+         self.entries[key] = data
+         self.entries.move_to_end(key)
+         while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+
+catalogCache = CatalogCache(path=os.environ.get('MAGDASH_CATCACHE', None))
@@ -6,11 +6,54 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord
 import datetime
 import numpy as np
+import erfa
+import os
+import time
+import threading
 from zoneinfo import ZoneInfo
 
 utc_tz = ZoneInfo("UTC")
 loc_tz = ZoneInfo("America/Santiago")
 
+# Which alt/az engine computeNightQuantities uses:  'astropy' (full
+# astropy/astroplan pipeline) or 'fast' (see fastAltAz)
+ALTAZ_ENGINE = os.environ.get('MAGDASH_ALTAZ', 'astropy')
+SIDEREAL_DAY = 0.99726956634    # in solar days
+
+@cache
+def getObserver(location='LCO'):
+   '''The astroplan Observer for location. Built once per process and shared
+   by all callers, since Observer.at_site() is expensive.'''
+   return Observer.at_site(location)
+
+@cache
+def _siteContext(location, night):
+   obs = getObserver(location)
+   try:
+      # UT1-UTC changes by < 1 ms over a night
+      dut1 = (Time(night) + 1*u.day).delta_ut1_utc
+   except Exception:
+      dut1 = None
+   return dict(obs=obs, lon=obs.location.lon, lat=obs.location.lat,
+               lonrad=obs.location.lon.radian, latrad=obs.location.lat.radian,
+               dut1=dut1)
+
+def siteContext(location='LCO', date=None):
+   '''Quantities for location that can be re-used for a whole night:  the
+   Observer, longitude and latitude (Angle and radians) and UT1-UTC. 
+   Computed once per site and night (see nightKey).'''
+   return _siteContext(location, nightKey(date))
+
+def localSiderealTime(date, location='LCO', kind='apparent'):
+   '''Local sidereal time at date (scalar or array Time). Same as 
+   Observer.local_sidereal_time(), but uses the night's UT1-UTC from 
+   siteContext() instead of looking it up in the IERS tables.'''
+   date = Time(date)
+   ctx = siteContext(location, date if date.isscalar else date[0])
+   if ctx['dut1'] is not None:
+      date.delta_ut1_utc = ctx['dut1']
+   return date.sidereal_time(kind, longitude=ctx['lon'])
+
 def airmass(h):
    '''Compute airmass from Pickering (2002) given altitude angle h
    
@@ -27,9 +70,91 @@ def airmass(h):
    arg = nh + 244./(165. + 47.*np.power(nh, 1.1))
    return np.power(np.sin(arg*np.pi/180), -1) 
 
+class NightCalendar:
+   '''Sunset, twilight and sunrise for each (site, night), computed once
+   with astroplan and kept for the life of the process. Nights are labelled
+   by the local date of the evening (see nightKey). A whole semester can be
+   precomputed and saved to disk with precompute() and save(); if
+   MAGDASH_NIGHTS points to such a file it is loaded at startup.'''
+
+   EVENTS = ['ss','te','tb','sr']
+
+   def __init__(self, path=None):
+      self.events = {}
+      self.grids = {}
+      if path is not None and os.path.isfile(path):
+         self.load(path)
+
+   def nightEvents(self, night, location='LCO'):
+      '''JDs of sunset, end of twilight, beginning of twilight and sunrise
+      for the night starting on the evening of the local date night'''
+      key = (location, night)
+      if key not in self.events:
+         obs = getObserver(location)
+         y,m,d = [int(x) for x in night.split('-')]
+         noon = Time(datetime.datetime(y, m, d, 12, tzinfo=loc_tz))
+         sunset = obs.sun_set_time(noon, which="next")
+         twilight_end = obs.twilight_evening_astronomical(sunset, which="next")
+         twilight_begin = obs.twilight_morning_astronomical(twilight_end, 
+                 which="next")
+         sunrise = obs.sun_rise_time(twilight_begin, which="next")
+         self.events[key] = np.array([sunset.jd, twilight_end.jd, 
+                                      twilight_begin.jd, sunrise.jd])
+      return self.events[key]
+
+   def nightOf(self, date=None, location='LCO'):
+      '''Label of the night to show at date:  the current night or, if 
+      the sun has already risen, the coming one.'''
+      date = Time.now() if date is None else Time(date)
+      night = nightKey(date)
+      if date.jd > self.nightEvents(night, location)[-1]:
+         dt = datetime.date.fromisoformat(night) + datetime.timedelta(days=1)
+         night = dt.isoformat()
+      return night
+
+   def night(self, date=None, location='LCO', deltat=5*u.minute):
+      '''Events and time grid (from sunset-1h to sunrise+1h in steps of 
+      deltat) of the night to show at date. See makeTimeRange().'''
+      night = self.nightOf(date, location)
+      key = (location, night, deltat.to('s').value)
+      if key not in self.grids:
+         ss,te,tb,sr = [Time(jd, format='jd', scale='utc') 
+                        for jd in self.nightEvents(night, location)]
+         start = ss - 1*u.hour
+         n = int(np.ceil(((sr - ss + 2*u.hour)/deltat).to('').value)) + 1
+         times = start + np.arange(n)*deltat
+         self.grids[key] = dict(sr=sr, ss=ss, tb=tb, te=te, times=times,
+                                times64=times.datetime64, night=night)
+      return dict(self.grids[key])
+
+   def precompute(self, start=None, nnights=183, location='LCO'):
+      '''Compute the events for nnights nights starting with night start 
+      (default: tonight)'''
+      if start is None:
+         start = nightKey()
+      day = datetime.date.fromisoformat(start)
+      for i in range(nnights):
+         self.nightEvents((day + datetime.timedelta(days=i)).isoformat(),
+                          location)
+
+   def save(self, path):
+      keys = sorted(self.events)
+      np.savez(path, locations=np.array([k[0] for k in keys]),
+               nights=np.array([k[1] for k in keys]),
+               events=np.array([self.events[k] for k in keys]))
+
+   def load(self, path):
+      with np.load(path) as f:
+         for loc,night,events in zip(f['locations'], f['nights'], 
+                                     f['events']):
+            self.events[(str(loc), str(night))] = events
+
+calendar = NightCalendar(os.environ.get('MAGDASH_NIGHTS', None))
+
 def makeTimeRange(date, location='LCO', deltat=5*u.minute):
    '''Given a time, find the previous sunset, next sunrise and grid the
-   time with N intervals.
+   time with N intervals. (If it's daytime, the coming night.) Served from
+   the NightCalendar, so the astroplan searches are done once per night.
    
    Args:
       date (astropy.Time):  Current UTC time
@@ -41,34 +166,77 @@ def makeTimeRange(date, location='LCO', deltat=5*u.minute):
              'ss':  sunset
              'tb':  twilight begins (end of night)
              'te':  twilight ends (beginning of night)
-             'times': the time values
+             'times': the time values (Time array)
+             'times64': the time values (numpy datetime64)
+             'night': the night label
    '''
-   obs = Observer.at_site(location)
-   #dt = date.datetime
-   #dt = datetime.datetime(dt.year, dt.month, dt.day, 3, 0, 0)   # 3AM UTC
-   #date = Time(dt, scale='utc')
-
-   # Logic here is to check for previous sunset and next sunrise (assume that
-   #  we're currently observing at night. But if not, the previous sunset may
-   #  be in the past (the day before), so check for that
-   sunset = obs.sun_set_time(date, which="previous")  
-   sunrise = obs.sun_rise_time(date, which="next")
-   if sunrise.jd - sunset.jd > 1:
-      # we're at daytime, so we want next sunset
-      sunset = obs.sun_set_time(date, which="next")
-   twilight_end = obs.twilight_evening_astronomical(sunset, which="next")
-   twilight_begin = obs.twilight_morning_astronomical(twilight_end, 
-           which="next")
-   sunrise = obs.sun_rise_time(twilight_begin, which="next")
-   times = [sunset - 1*u.hour]
-   while times[-1] < sunrise + 1*u.hour:
-      times.append(times[-1] + deltat)
-   data = dict(sr=sunrise, ss=sunset, tb=twilight_begin, te=twilight_end,
-               times=times)
-   #print(data)
-   return data
+   return calendar.night(date, location, deltat)
 
-def computeNightQuantities(data, date=None, location='LCO', deltat=5*u.minute):
+def precessionMatrix(date):
+   '''The bias-precession-nutation matrix (IAU 2006/2000A) that rotates ICRS
+   vectors to the true equator and equinox of date.'''
+   t = Time(date).tt
+   return erfa.pnm06a(t.jd1, t.jd2)
+
+def precessToDate(RA, DE, date=None):
+   '''Rotate ICRS RA (hours) and DE (degrees) to the true equator and
+   equinox of date (default: now). Returns (RA,DE) in hours and degrees.'''
+   if date is None:
+      date = Time.now()
+   RA = np.atleast_1d(np.asarray(RA, dtype=float))*np.pi/12
+   DE = np.atleast_1d(np.asarray(DE, dtype=float))*np.pi/180
+   M = precessionMatrix(date)
+   v = M @ np.array([np.cos(DE)*np.cos(RA), np.cos(DE)*np.sin(RA), np.sin(DE)])
+   ra = np.mod(np.arctan2(v[1], v[0]), 2*np.pi)
+   de = np.arcsin(np.clip(v[2], -1, 1))
+   return ra*12/np.pi, de*180/np.pi
+
+def fastAltAz(RA, DE, times, location='LCO'):
+   '''Compute altitude and azimuth for all targets at all times using plain
+   numpy spherical trig. Coordinates are rotated to the equator of date
+   once (using the middle of the times) and the apparent LST is computed 
+   once for the whole time grid.
+   
+   Args:
+      RA(float array):  ICRS right ascension in hours
+      DE(float array):  ICRS declination in degrees
+      times(astropy.Time):  times (array or list of Time)
+      location(string):  observer's location (Observer.at_site())
+
+   Returns:
+      (alt,az):  NxT arrays in degrees (az is E of N)
+
+   Note:
+      Annual and diurnal aberration, polar motion and refraction are 
+      ignored. (astroplan's Observer has pressure=0, so astropy doesn't
+      refract either.) Compared to Observer.altaz() the error is < 30 arcsec
+      and always < 1 arcmin.'''
+   times = Time(times)
+   ctx = siteContext(location, times[0])
+   ra,de = precessToDate(RA, DE, times[len(times)//2])
+   ra,de = ra*np.pi/12,de*np.pi/180
+   lst = localSiderealTime(times, location).radian
+   lat = ctx['latrad']
+
+   H = lst[np.newaxis,:] - ra[:,np.newaxis]
+   sde,cde = np.sin(de)[:,np.newaxis],np.cos(de)[:,np.newaxis]
+   cH = np.cos(H)
+   alt = np.arcsin(np.clip(sde*np.sin(lat) + cde*np.cos(lat)*cH, -1, 1))
+   az = np.arctan2(-cde*np.sin(H), sde*np.cos(lat) - cde*np.sin(lat)*cH)
+   return alt*180/np.pi, np.mod(az*180/np.pi, 360)
+
+def fastTransit(RA, DE, date, location='LCO'):
+   '''Meridian transit nearest to date (like astroplan's default). Agrees
+   with astroplan's grid search to within a few minutes.'''
+   date = Time(date)
+   ra,de = precessToDate(RA, DE, date)
+   ra = ra*np.pi/12
+   lst = localSiderealTime(date, location).radian
+   dH = np.mod(ra - lst + np.pi, 2*np.pi) - np.pi
+   return date + dH/(2*np.pi)*SIDEREAL_DAY*u.day
+
+def computeNightQuantities(data, date=None, location='LCO', deltat=5*u.minute,
+                           engine=None):
    '''Take the data from target list and derive quantities needed for
    the dashboard than span the night (ie., only need to compute once/night/list).
    
@@ -79,6 +247,8 @@ def computeNightQuantities(data, date=None, location='LCO', deltat=5*u.minute):
                    astropy.time.Time() understands. Default:  now
       location(string):  observer location (astropy.Observer.at_site)
       deltat(time unit):  time interval for timerange of HA, airmass, etc
+      engine(string):  'astropy' or 'fast' (see fastAltAz). 
+                       Default: ALTAZ_ENGINE
    
    Returns:
       dict with keys:
@@ -87,7 +257,7 @@ def computeNightQuantities(data, date=None, location='LCO', deltat=5*u.minute):
             'AM':   Airmass for all objects
             'transit': Meridian transit time (astropy.time.Time)'''
 
-   obs = Observer.at_site(location)
+   obs = getObserver(location)
    if date is None:
       date = Time.now()
    else:
@@ -99,22 +269,41 @@ def computeNightQuantities(data, date=None, location='LCO', deltat=5*u.minute):
    t = FixedTarget(c)
    res = makeTimeRange(date, location, deltat)
    for key in res:
+      if key == 'night': continue
       data[key] = res[key]
 
-   aa = obs.altaz(res['times'], t, grid_times_targets=True)
-   data['alts'] = aa.alt.to('degree').value
-   data['az'] = aa.az.to('degree').value
-   data['AM'] = airmass(aa.alt.to('degree').value)
-   data['transit'] = obs.target_meridian_transit_time(date, t)
+   if engine is None:
+      engine = ALTAZ_ENGINE
+   if engine == 'fast':
+      data['alts'],data['az'] = fastAltAz(data['RA'], data['DE'], 
+                                          res['times'], location)
+      data['transit'] = fastTransit(data['RA'], data['DE'], date, location)
+   else:
+      aa = obs.altaz(res['times'], t, grid_times_targets=True)
+      data['alts'] = aa.alt.to('degree').value
+      data['az'] = aa.az.to('degree').value
+      data['transit'] = obs.target_meridian_transit_time(date, t)
+   data['AM'] = airmass(data['alts'])
    data['targets'] = t
    data['t0'] = res['times'][0].datetime
    data['t1'] = res['times'][-1].datetime
+   data['tjd'] = res['times'].jd
 
    return data
 
+def nightKey(date=None):
+   '''A label for the observing night that date falls in: the local date
+   of the evening the night started (so 03:00 local belongs to the night
+   before).'''
+   if date is None:
+      date = Time.now()
+   else:
+      date = Time(date)
+   dt = date.datetime.replace(tzinfo=utc_tz).astimezone(loc_tz)
+   return (dt - datetime.timedelta(hours=12)).strftime("%Y-%m-%d")
+
 def computeTimes(date=None, location='LCO'):
    " compute the current times (local, sidereal, utc)"
-   obs = Observer.at_site(location)
    if date is None:
       date = Time.now()
    else:
@@ -123,16 +312,84 @@ def computeTimes(date=None, location='LCO'):
    dt2 = dt.astimezone(loc_tz)
    UT = dt.strftime("%H:%M:%S")
    LT = dt2.strftime("%H:%M:%S")
-   ST = obs.local_sidereal_time(date).to_string(precision=0, sep=':')
+   ST = localSiderealTime(date, location).to_string(precision=0, sep=':')
    return(UT,LT,ST)
 
 
+class SiderealClock:
+   '''Formatted UT, LT and ST strings for the status buttons, cheap enough
+   to call every second from every session. LST comes from a linear model
+   (the sidereal rate) anchored on one astropy evaluation and re-anchored
+   every refresh seconds. The strings are cached per second, so sessions
+   ticking in the same second share them.
+
+   Args:
+      location(string):  observer's location (Observer.at_site())
+      refresh(float):  seconds between astropy re-anchoring'''
+
+   RATE = 1.00273790935    # sidereal seconds per (UT1) second
+
+   def __init__(self, location='LCO', refresh=3600):
+      self.location = location
+      self.refresh = refresh
+      self.anchor = None
+      self.lst0 = None
+      self.last = (None, None)
+      self.lock = threading.Lock()
+
+   def lst(self, now=None, reanchor=True):
+      '''Local sidereal time in hours at unix time now (default: now). If
+      reanchor is False, the current anchor is extrapolated (good to well
+      under a second over several days).'''
+      if now is None:
+         now = time.time()
+      with self.lock:
+         if self.anchor is None or \
+               (reanchor and abs(now - self.anchor) > self.refresh):
+            self.lst0 = localSiderealTime(Time(now, format='unix'),
+                                          self.location).hour
+            self.anchor = now
+         return (self.lst0 + (now - self.anchor)*self.RATE/3600) % 24
+
+   def strings(self, now=None, reanchor=True):
+      '''(UT,LT,ST) strings (HH:MM:SS) at unix time now (default: now)'''
+      if now is None:
+         now = time.time()
+      sec = int(now)
+      last = self.last
+      if last[0] == sec:
+         return last[1]
+      dt = datetime.datetime.fromtimestamp(sec, utc_tz)
+      UT = dt.strftime("%H:%M:%S")
+      LT = dt.astimezone(loc_tz).strftime("%H:%M:%S")
+      st = int(round(self.lst(sec, reanchor)*3600)) % 86400
+      ST = "{:02d}:{:02d}:{:02d}".format(st//3600, (st//60) % 60, st % 60)
+      self.last = (sec, (UT,LT,ST))
+      return self.last[1]
+
+# Process-wide clock shared by all sessions
+clock = SiderealClock()
+
+def currentContext(date=None):
+   '''What the current quantities of every target list share at date
+   (default: now):  dict(now=Time, lst=LST in hours, UT, LT, ST strings).
+   Computed once a minute for all sessions by the scheduler (main.py).'''
+   unix = time.time() if date is None else Time(date).unix
+   UT,LT,ST = clock.strings(unix)
+   return dict(now=Time(unix, format='unix'), lst=clock.lst(unix), UT=UT,
+               LT=LT, ST=ST)
+
+@cache
+def siderealClock(location='LCO'):
+   '''The process-wide SiderealClock of location'''
+   return clock if location == clock.location else SiderealClock(location)
+
 def computeCurrentQuantities(targets, date=None, location='LCO'):
    if date is None:
       date = Time.now()
    else:
       date = Time(date)
-   obs = Observer.at_site(location)
+   obs = getObserver(location)
    res = {}
    
    aa = obs.altaz(date, targets)
@@ -140,7 +397,7 @@ def computeCurrentQuantities(targets, date=None, location='LCO'):
    res['az'] = aa.az.to('degree').value
    res['zang'] = 90 - res['alt']  # zenith angle
    res['AM'] = airmass(aa.alt.to('degree').value)
-   res['HA'] = (targets.ra - obs.local_sidereal_time(date)).to('hourangle').value
+   res['HA'] = (targets.ra - localSiderealTime(date, location)).to('hourangle').value
    UT,LT,ST = computeTimes(date, location)
    res['UT'] = UT
    res['LT'] = LT
@@ -148,6 +405,55 @@ def computeCurrentQuantities(targets, date=None, location='LCO'):
    res['now'] = date
    return(res)
 
+def interpCurrentQuantities(data, date=None, location='LCO', context=None):
+   '''Same as computeCurrentQuantities(), but the alt/az are interpolated
+   from the night grid computed by computeNightQuantities() and the LST
+   comes from the shared clock, so there are no astropy coordinate 
+   transformations (O(N) numpy). Falls back on computeCurrentQuantities()
+   if date is outside the night grid.
+   
+   Args:
+      data(dict):  output of computeNightQuantities()
+      date(misc):  anything astropy.time.Time() understands. Default: now
+      location(string):  observer location (astropy.Observer.at_site)
+      context(dict):  currentContext() to use (instead of date)'''
+   if context is not None:
+      date = context['now']
+   elif date is None:
+      date = Time(time.time(), format='unix')
+   else:
+      date = Time(date)
+   tjd = data.get('tjd', None)
+   if tjd is None:
+      tjd = Time(data['times']).jd
+   jd = date.jd
+   if len(tjd) < 2 or not tjd[0] <= jd <= tjd[-1]:
+      return computeCurrentQuantities(data['targets'], date, location)
+
+   i = min(max(np.searchsorted(tjd, jd) - 1, 0), len(tjd) - 2)
+   w = (jd - tjd[i])/(tjd[i+1] - tjd[i])
+   alts = np.asarray(data['alts'])
+   az = np.asarray(data['az'])
+   res = {}
+   res['alt'] = alts[:,i]*(1 - w) + alts[:,i+1]*w
+   # interpolate azimuth the short way around
+   daz = np.mod(az[:,i+1] - az[:,i] + 180, 360) - 180
+   res['az'] = np.mod(az[:,i] + w*daz, 360)
+   res['zang'] = 90 - res['alt']  # zenith angle
+   res['AM'] = airmass(res['alt'])
+   if context is None:
+      unix = date.unix
+      context = dict(lst=clock.lst(unix, reanchor=False))
+      context['UT'],context['LT'],context['ST'] = clock.strings(unix, 
+                                                                reanchor=False)
+   res['HA'] = np.asarray(data['RA'], dtype=float) - context['lst']
+   UT,LT,ST = context['UT'],context['LT'],context['ST']
+   res['UT'] = UT
+   res['LT'] = LT
+   res['ST'] = ST
+   res['now'] = date
+   return(res)
+
 def LSTtoStr(lst):
     hour = int(lst.hour)
     minute = int((lst.hour-hour)*60)
@@ -160,7 +466,6 @@ def computeNightParams(date=None, location='LCO'):
       date = Time.now()
    else:
       date = Time(date)
-   obs = Observer.at_site(location)
 
    data = dict(
            label=['Sunset','Twilight end','Mid point','Twilight begin',
@@ -171,9 +476,9 @@ def computeNightParams(date=None, location='LCO'):
    mid = Time(mid, format='jd')
    moon = moon_illumination(mid)
    duration = (times['sr'].jd-times['ss'].jd)*24
-   lstset = obs.local_sidereal_time(times['ss'])
-   lstmid = obs.local_sidereal_time(mid)
-   lstrise = obs.local_sidereal_time(times['sr'])
+   lstset = localSiderealTime(times['ss'], location)
+   lstmid = localSiderealTime(mid, location)
+   lstrise = localSiderealTime(times['sr'], location)
    tformat = "%H:%M:%S"
    data['value'] = [times['ss'].strftime(tformat),
                     times['te'].strftime(tformat),
@@ -188,3 +493,14 @@ def computeNightParams(date=None, location='LCO'):
                     "{:.1f} %".format(moon*100)]
    return data
 
+if __name__ == '__main__':
+   import argparse
+   parser = argparse.ArgumentParser(description="Precompute the night "
+                                    "calendar (use with MAGDASH_NIGHTS)")
+   parser.add_argument('output', help='output file (.npz)')
+   parser.add_argument('--start', help='first night (YYYY-MM-DD)')
+   parser.add_argument('--nights', type=int, default=183)
+   parser.add_argument('--location', default='LCO')
+   args = parser.parse_args()
+   calendar.precompute(args.start, args.nights, args.location)
+   calendar.save(args.output)
@@ -5,72 +5,99 @@ from bokeh.models import (RangeSlider, Slider, Select, CheckboxButtonGroup,
                           MultiChoice, ColumnDataSource, FileInput,
                           TableColumn, NumberFormatter, DataTable,
                           HTMLTemplateFormatter,CDSView,PasswordInput,Button,
-                          Div, CheckboxGroup)
+                          Div, CheckboxGroup, CustomJSTickFormatter,
+                          CustomJSTransform)
 from bokeh.models.filters import BooleanFilter,AllIndices
 from bokeh.palettes import Viridis6
+from bokeh.core.property.validation import without_property_validation
 from astroplan import Observer
 import base64
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, Angle
 from astropy import units as u
 from astropy.time import Time
-from .compute import computeCurrentQuantities,computeNightQuantities,computeNightParams
+from .compute import computeCurrentQuantities,computeNightQuantities,computeNightParams,\
+                     makeTimeRange,precessToDate,interpCurrentQuantities
+from .catcache import catalogCache
+from .targettable import TargetTable
+from .shared import sharedCache
 import numpy as np
 import traceback
+import time
+
+# The time axis is the same for all targets, so it is sent once (in 
+# ObjectData.timeAxis) and the x values of each airmass track are filled in
+# by this transform in the browser.
+timeAxisJS = '''
+const t = axis.data.t
+return xs.map(() => t)
+'''
+
+MAGCAT_FIELDS = ['ID','Name','RA','DE','equinox','pmRA','pmDEC','rotoff',
+                 'rotmode','gp1RA','gp1DEC','gp1equ','gp2RA','gp2DEC','gp2equ',
+                 'obsEpoch']
+MAGCAT_FLOATS = ['equinox','pmRA','pmDEC','rotoff','gp1equ','gp2equ',
+                 'obsEpoch']
+# What missing trailing fields are filled with
+MAGCAT_PAD = ['0' if field in MAGCAT_FLOATS else '' for field in MAGCAT_FIELDS]
+
+def sexToDecimal(values, unit=u.degree):
+   '''Convert an array of sexagesimal strings (e.g., "-12:30:00") to decimal
+   values in the same units. Everything is done in a handful of array 
+   operations. If any value is not of the form xx:xx:xx, falls back on 
+   a single vectorized SkyCoord-style Angle conversion.'''
+   values = np.asarray(values, dtype=str)
+   if len(values) == 0:
+      return np.array([])
+   if np.all(np.char.count(values, ':') == 2):
+      try:
+         dms = np.array(" ".join(np.char.replace(values, ':', ' ')).split(),
+                        dtype=float).reshape(-1,3)
+      except ValueError:
+         dms = None
+      if dms is not None:
+         sign = np.where(np.char.startswith(np.char.lstrip(values), '-'), 
+                         -1, 1)
+         return sign*(np.absolute(dms[:,0]) + dms[:,1]/60 + dms[:,2]/3600)
+   return Angle(values, unit=unit).to(unit).value
 
 def readMagCat(input):
-   fields = ['ID','Name','RA','DE','equinox','pmRA','pmDEC','rotoff','rotmode',
-             'gp1RA','gp1DEC','gp1equ','gp2RA','gp2DEC','gp2equ','obsEpoch',
-             'comm']
-
-   data = {}.fromkeys(fields)
-   for field in fields:  data[field] = []
-   lines = input.split(b'\n')
-   N = 0
-   for line in lines:
-      line = line.decode("utf-8")
+   '''Parse a Magellan catalog (bytes) into a TargetTable. Numeric fields
+   are float arrays, RA (hours) and DE (degrees) are converted to decimal.'''
+   rows = []
+   comms = []
+   for line in input.decode("utf-8").split('\n'):
       if len(line) == 0 or line[0] == "#": continue
       
-      N += 1
       # check of end comment (which may have spaces)
-      fs = line.split('#')
-      if len(fs) == 1:
-         data['comm'].append('')
-      elif len(fs) == 2:
-         data['comm'].append(fs[1].strip())
-      else:
-         # '#' includded in comment
-         data['comm'].append('#'.join(fs[1:]))
-
-      fs = fs[0].split()
+      line,sep,comm = line.partition('#')
+      if '#' not in comm:
+         comm = comm.strip()
+      fs = line.split()
+      if len(fs) == 0: continue
       if len(fs) > 16:
          # Treat end fields as comments. This is not the stndard, but whatevs
-         data['comm'][-1] += " ".join(fs[16:])
+         comm += " ".join(fs[16:])
          fs = fs[:16]
+      # Missing data (incl. no epoch, which we assume to be 0.0)
+      rows.append(fs + MAGCAT_PAD[len(fs):])
+      comms.append(comm)
 
-      for i in range(len(fs)):
-         field = fields[i]
-         if field in ['equinox','pmRA','pmDEC','rotoff','gp1equ','gp2equ',
-                      'obsEpoch']:
-            data[field].append(float(fs[i]))
-         else:
-            data[field].append(fs[i])
-      if i < 15:
-         # Missing data
-         for i in range(i+1,16):
-            field = fields[i]
-            if field in ['equinox','pmRA','pmDEC','rotoff','gp1equ','gp2equ',
-                         'obsEpoch']:
-               data[field].append(0)
-            else:
-               data[field].append('')
-
-      coord = SkyCoord(data['RA'][-1],data['DE'][-1], 
-                       unit=(u.hourangle,u.degree))
-      data['RA'][-1] = coord.ra.to('hourangle').value
-      data['DE'][-1] = coord.dec.to('degree').value
-      if len(fs) == 15:    # No epoch given... assume 0.0
-         data['obsEpoch'].append(0.0)
-   data['N'] = N
+   data = TargetTable()
+   columns = list(zip(*rows)) if rows else [()]*len(MAGCAT_FIELDS)
+   for field,column in zip(MAGCAT_FIELDS, columns):
+      if field in MAGCAT_FLOATS:
+         data.addColumn(field, np.array(column, dtype=float))
+      else:
+         data.addColumn(field, np.array(column, dtype=str))
+   # Same checks as SkyCoord:  RA wrapped to [0,24), |DE| <= 90
+   data.addColumn('RA', np.mod(sexToDecimal(data['RA'], u.hourangle), 24))
+   data.addColumn('DE', sexToDecimal(data['DE'], u.degree))
+   bad = np.absolute(data['DE']) > 90
+   if np.any(bad):
+      raise ValueError("Latitude angle(s) must be within -90 deg <= angle "
+                       "<= 90 deg, got {} deg".format(data['DE'][bad]))
+   data.addColumn('comm', np.array(comms, dtype=str))
+   data['N'] = len(rows)
       
    return data
 
@@ -84,6 +111,21 @@ class ObjectData:
             'POISE:IMACS':"QWFCCD",
             'POISE:FIRE':"QFIRE"}
 
+   # How current quantities are computed:  'interp' (from the night grid) or
+   # 'astropy' (computeCurrentQuantities)
+   NOW_MODE = 'interp'
+
+   # Changes smaller than these (in the units of the source columns) are
+   # not sent to the browser
+   PATCH_TOL = dict(HA=1./3600, AM=1e-3, zang=1./60, az=np.pi/180/60, 
+                    alt=1./60, RAd=1./3600/15, DEd=1./3600)
+   # If more than this fraction of the rows between the first and last
+   # changed ones changed, send them as one slice rather than cell by cell
+   PATCH_FRAC = 0.5
+   # Updates of the source columns are sent at most once per PUSH_INTERVAL
+   # seconds. Those made in between are merged (the latest values win).
+   PUSH_INTERVAL = 0.5
+
    cadences = {'Raw-high':1,
                'High':1,
                'Medium':2,
@@ -105,6 +147,11 @@ class ObjectData:
       self.CSPSubmit = Button(label="Get Data", visible=False,
                               margin=(25,5,5,5))
       self.CSPSubmit.on_click(self.fetchQueue)
+      self.CSPRefresh = Button(label="Force Refresh", visible=False,
+                               margin=(25,5,5,5))
+      self.CSPRefresh.on_click(self.refreshQueue)
+      self.autoRefresh = CheckboxGroup(labels=["Auto-refresh"], active=[],
+                                       visible=False, margin=(30,5,5,5))
       self.dataSourceMessage = Div(text="N/A", width=200, margin=(25,5,5,5),
                                    visible=False)
 
@@ -138,22 +185,28 @@ class ObjectData:
       self.observeSelector = CheckboxGroup(labels=["Observe = Y","Observe = N"],
               active=[], visible=False)
 
-      # -----  The initial DataColumnSource with no objects
-      self.data = dict(
-         RA = np.array([]),
-         DE = np.array([]),
-         alts = np.array([]),
-         alt = np.array([]),
-         az = np.array([]),
-         ID = [],
-         AM = np.array([]),
-         Name = [],
-         comm = []
-      )
-      self.data = computeNightQuantities(self.data)
-      self.now = computeCurrentQuantities(self.data['targets'])
+      # ------------------ TIME SCRUBBER (UT, ms since epoch)
+      self.timeSlider = Slider(start=0, end=1, value=0, step=60000, 
+            title="Time (UT)", format=CustomJSTickFormatter(code=\
+            "return new Date(tick).toISOString().substring(11,16)"))
+      self.timeSlider.on_change('value_throttled', self.scrubTime)
+      self.liveTime = CheckboxGroup(labels=["Now"], active=[0])
+      self.liveTime.on_change('active', self.updateLive)
+
+      # -----  The initial DataColumnSource with no objects (the night grid
+      # is shared by all sessions)
+      self.data = dict(sharedCache.night())
+      self.now = self.currentQuantities()
       self.source = None
       self.view = None
+      self.pending = {}       # column updates not sent yet
+      self.flushing = False   # a flushColumns() is scheduled
+      self.lastPush = 0
+      # Shared time axis (ms since epoch) of the airmass tracks. Use
+      # xs=transform('alts', self.timeTransform) to plot them.
+      self.timeAxis = ColumnDataSource(dict(t=np.array([])))
+      self.timeTransform = CustomJSTransform(args=dict(axis=self.timeAxis),
+                                             v_func=timeAxisJS)
       self.makeDataSource()
       self.Nameformatter = HTMLTemplateFormatter(template=\
          '<strong> <%= value %> </strong>')
@@ -168,6 +221,8 @@ class ObjectData:
          # POISE data from SQL and has more filters
          self.CSPpasswd.visible = True
          self.CSPSubmit.visible = True
+         self.CSPRefresh.visible = True
+         self.autoRefresh.visible = True
          self.magellanCatalog.visible = False
          if query.PASS:
             self.CSPpasswd.value = query.PASS
@@ -175,6 +230,8 @@ class ObjectData:
       else:
          self.CSPpasswd.visible = False
          self.CSPSubmit.visible = False
+         self.CSPRefresh.visible = False
+         self.autoRefresh.visible = False
          self.magellanCatalog.visible = True
          self.ageSlider.visible = False
          self.cadSlider.visible = False
@@ -184,46 +241,204 @@ class ObjectData:
          self.table.columns[1].formatter = HTMLTemplateFormatter(template=\
          '<strong> <%= value %> </strong>')
 
+   def makeFilterIndex(self):
+      '''Build the index used by updateViewFilter:  the minimum airmass of
+      each target, RA and DEC sorted (for range bisection) and integer codes
+      for the categorical columns (Tags, camp, priority). Needs to be re-built
+      whenever these columns change.'''
+      data = self.source.data
+      RA = np.asarray(data['RA'], dtype=float)
+      DE = np.asarray(data['DE'], dtype=float)
+      self.index = dict(N=len(RA),
+         minAM=self.tracks['AM'].min(axis=1) if len(RA) else np.array([]),
+         RAorder=np.argsort(RA, kind='stable'),
+         DEorder=np.argsort(DE, kind='stable'))
+      self.index['RA'] = RA[self.index['RAorder']]
+      self.index['DE'] = DE[self.index['DEorder']]
+      for key in ['Tags','camp','priority']:
+         if key in data:
+            self.index[key] = np.unique(np.asarray(data[key], dtype=str),
+                                        return_inverse=True)
+
+   def rangeMask(self, key, lo, hi):
+      '''Boolean mask of the rows with lo <= key <= hi using the index'''
+      i0 = np.searchsorted(self.index[key], lo, side='left')
+      i1 = np.searchsorted(self.index[key], hi, side='right')
+      bools = np.zeros(self.index['N'], dtype=bool)
+      bools[self.index[key+'order'][i0:i1]] = True
+      return bools
+
+   def categoryMask(self, key, values):
+      '''Boolean mask of the rows whose column key is one of values'''
+      cats,codes = self.index[key]
+      return np.isin(codes, np.nonzero(np.isin(cats, values))[0])
+
+   @without_property_validation
    def updateViewFilter(self, attr, old, new):
+      '''Re-build the view's BooleanFilter from the filter widgets. The 
+      booleans are a numpy array built from the filter index, so property
+      validation (which checks each element) is skipped.'''
       data = self.source.data
-      bools = (data['RA'] >= self.RArange.value[0]) & \
-         (data['RA'] <= self.RArange.value[1])
-      bools &= ((data['DE'] >= self.DECrange.value[0]) & \
-         (data['DE'] <= self.DECrange.value[1]))
+      bools = self.rangeMask('RA', *self.RArange.value)
+      bools &= self.rangeMask('DE', *self.DECrange.value)
       if self.minAirmass.value < 3:
-         bools &= np.array([AMs.min() < self.minAirmass.value \
-                            for AMs in data['AMs']]) 
-      if self.ageSlider.visible:
+         bools &= self.index['minAM'] < self.minAirmass.value
+      if self.ageSlider.visible and 'age' in data:
          bools &= ((data['age'] >= self.ageSlider.value[0]) &\
                    (data['age'] <= self.ageSlider.value[1]))
-      if self.cadSlider.visible:
+      if self.cadSlider.visible and 'cad' in data:
          bools &= (np.isnan(data['cad']) | ((data['cad'] >= self.cadSlider.value[0]) &\
                    (data['cad'] <= self.cadSlider.value[1])))
       if self.tagSelector.value:
-         bools &= np.array([tag in self.tagSelector.value \
-                         for tag in data['Tags']])
+         bools &= self.categoryMask('Tags', self.tagSelector.value)
       if self.campSelect.visible and self.campSelect.value:
-         bools &= np.array([tag in self.campSelect.value \
-                            for tag in data['camp']])
+         bools &= self.categoryMask('camp', self.campSelect.value)
       if self.prioritySelect.visible and self.prioritySelect.active:
          selected_priorities = [self.prioritySelect.labels[idx] \
                                 for idx in self.prioritySelect.active]
-         bools &= np.array([tag in selected_priorities \
-                            for tag in data['priority']])
+         bools &= self.categoryMask('priority', selected_priorities)
       #if self.observeSelector.visible and self.observe.Selector.active:
       #    observe = [
       
-      self.view.filter = BooleanFilter(booleans=bools)
+      self.view.filter.booleans = bools
+
+   def currentQuantities(self, date=None, context=None):
+      '''Current alt, az, HA, etc of the targets at date (default: now), or
+      at the shared compute.currentContext() context'''
+      if self.NOW_MODE == 'interp':
+         return interpCurrentQuantities(self.data, date, context=context)
+      if context is not None:
+         date = context['now']
+      return computeCurrentQuantities(self.data['targets'], date)
+
+   def updateNow(self, date=None, context=None):
+      '''Re-compute the current quantities at date (default: now, or the
+      shared per-minute context from the scheduler) and update the source'''
+      self.now = self.currentQuantities(date, context)
+      self.updateColumns(dict(HA=self.now['HA'], AM=self.now['AM'],
+                              zang=self.now['zang'], 
+                              az=self.now['az']*np.pi/180,
+                              alt=self.now['alt']))
+      if date is None:
+         self.timeSlider.value = min(max(self.now['now'].unix*1000, 
+                              self.timeSlider.start), self.timeSlider.end)
+
+   def changedRows(self, key, new):
+      '''Indices of the rows of source column key that differ from new by
+      more than PATCH_TOL, or None if the column can't be compared (new
+      column or different length)'''
+      if key not in self.source.data:
+         return None
+      old = self.source.data[key]
+      if len(old) != len(new):
+         return None
+      if isinstance(new, np.ndarray) and new.dtype.kind == 'f':
+         old = np.asarray(old, dtype=float)
+         tol = self.PATCH_TOL.get(key, 0)
+         same = (np.absolute(new - old) <= tol) | \
+                (np.isnan(new) & np.isnan(old))
+         return np.nonzero(~same)[0]
+      return np.array([i for i in range(len(new)) \
+            if not np.array_equal(np.asarray(old[i]), np.asarray(new[i]))],
+            dtype=int)
+
+   def updateColumns(self, cols):
+      '''Queue new values for some columns of the source. They are sent by
+      flushColumns(), at most once per PUSH_INTERVAL (right away if the
+      source isn't in a document yet).'''
+      self.pending.update(cols)
+      doc = self.source.document
+      if doc is None:
+         self.flushColumns()
+      elif not self.flushing:
+         self.flushing = True
+         wait = self.lastPush + self.PUSH_INTERVAL - time.time()
+         if wait > 0:
+            doc.add_timeout_callback(self.flushColumns, wait*1000)
+         else:
+            doc.add_next_tick_callback(self.flushColumns)
+
+   def flushColumns(self):
+      '''Send the queued column updates to the browser, all in one patch
+      event. Only cells that changed (by more than PATCH_TOL) are sent:  
+      cell by cell, or as one slice from the first to the last changed row
+      if more than PATCH_FRAC of those changed (e.g., HA every minute).
+      New columns, columns that changed length and read-only columns are
+      replaced.'''
+      cols,self.pending = self.pending,{}
+      self.flushing = False
+      self.lastPush = time.time()
+      patches = {}
+      replace = {}
+      for key,new in cols.items():
+         if isinstance(new, np.ndarray) or not isinstance(new, list):
+            new = np.asarray(new)
+         idx = self.changedRows(key, new)
+         old = self.source.data.get(key)
+         if idx is None or isinstance(old, tuple) or \
+               (isinstance(old, np.ndarray) and not old.flags.writeable):
+            replace[key] = new
+         elif len(idx) == 0:
+            continue
+         elif len(idx) > self.PATCH_FRAC*(idx[-1] - idx[0] + 1):
+            patches[key] = [(slice(int(idx[0]), int(idx[-1])+1), 
+                             new[idx[0]:idx[-1]+1])]
+         else:
+            patches[key] = [(int(i),new[i]) for i in idx]
+      if replace:
+         self.source.data.update(replace)
+      if patches:
+         self.source.patch(patches)
+
+   def scrubTime(self, attr, old, new):
+      '''The user moved the time slider:  show the targets at that time'''
+      self.liveTime.active = []
+      self.updateNow(Time(new/1000, format='unix'))
+
+   def updateLive(self, attr, old, new):
+      if new:
+         self.updateNow()
+
+   def ageCadence(self):
+      '''Age (days since agerdate) and cadence (days since last observed)
+      of the CSP targets, or None if not available'''
+      age = cad = None
+      if 'agerdate' in self.data:
+         epoch = np.array(self.data['agerdate'])
+         age = np.where(epoch > 1.0, self.now['now'].jd - epoch, 0.0)
+      if 'jdcad' in self.data:
+         # UT date of last observation
+         #UTs = Time(self.data['utobs'])
+         deltat = self.now['now'].jd - np.array(self.data['jdcad'])+0.5
+         cad = np.where(deltat < 9000, deltat, np.nan)
+      return age,cad
+
+   def observeFlags(self, cad, priority):
+      '''Y/N flag for whether a target is due, given its cadence'''
+      # cadence (days) of each priority, nan if not a cadence priority
+      cats,codes = np.unique(np.asarray(priority, dtype=str), 
+                             return_inverse=True)
+      due = np.array([self.cadences.get(p, np.nan) for p in cats])[codes]
+      cad = np.asarray(cad, dtype=float)
+      return np.where((cad != 0) & ~np.isnan(due), 
+                      np.where(cad >= due, 'Y', 'N'), '-')
 
    def makeDataSource(self):
       '''Given the current data, create the ColumnDataSource'''
       if self.data is None:
          return
-      dts = [t.datetime for t in self.data['times']]
-      d = dict(times=[dts for x in self.data['AM']],
-               AMs = [np.array(x) for x in self.data['AM']],
-               AM = np.array(self.data['AM']),
-               alts = [np.array(x) for x in self.data['alts']],
+      dts = self.data.get('times64', None)
+      if dts is None:
+         dts = Time(self.data['times']).datetime64
+      self.timeAxis.data = dict(t=np.asarray(dts, dtype='datetime64[ms]').\
+                                astype(np.float64))
+      # The per-target tracks as contiguous NxT float32 arrays. The source
+      # gets row views of alts (no copies), which Bokeh sends as binary.
+      self.tracks = dict(
+         AM=np.ascontiguousarray(self.data['AM'], dtype=np.float32),
+         alts=np.ascontiguousarray(self.data['alts'], dtype=np.float32))
+      d = dict(AM = np.array(self.now['AM']),
+               alts = list(self.tracks['alts']),
                Name = self.data['Name'],
                RA = np.array(self.data['RA']),
                DE = np.array(self.data['DE']),
@@ -234,6 +449,8 @@ class ObjectData:
                HA = np.array(self.now['HA']),
                Tags = self.data['comm']
          )
+      # Coordinates of date, for computing positions in the browser
+      d['RAd'],d['DEd'] = precessToDate(d['RA'], d['DE'], self.now['now'])
 
       # Some CSP-specific data
       if 'camp' in self.data:
@@ -244,18 +461,15 @@ class ObjectData:
          self.prioritySelect.labels = [priority \
                                        for priority in self.PRIORITY_OPTIONS \
                                        if priority in self.data['priority']]
-      if 'agerdate' in self.data:
-         epoch = np.array(self.data['agerdate'])
-         d['age'] = np.where(epoch > 1.0, self.now['now'].jd - epoch, 0.0)
+      age,cad = self.ageCadence()
+      if age is not None:
+         d['age'] = age
          self.ageSlider.start = d['age'].min()-1
          self.ageSlider.end = d['age'].max()+1
          self.ageSlider.step = (self.ageSlider.end-self.ageSlider.start)/100
          self.ageSlider.value = (self.ageSlider.start, self.ageSlider.end)
-      if 'jdcad' in self.data:
-         # UT date of last observation
-         #UTs = Time(self.data['utobs'])
-         deltat = self.now['now'].jd - np.array(self.data['jdcad'])+0.5
-         d['cad'] = np.where(deltat < 9000, deltat, np.nan)
+      if cad is not None:
+         d['cad'] = cad
          self.cadSlider.start = d['cad'][~np.isnan(d['cad'])].min()-1
          self.cadSlider.end = d['cad'][~np.isnan(d['cad'])].max()+1
          self.cadSlider.step = (self.cadSlider.end-self.cadSlider.start)/100
@@ -263,36 +477,47 @@ class ObjectData:
 
       # Set observe flag
       if self.dataSource.value == "POISE:Swope":
-         d['observe'] = []
-         for i,c in enumerate(d['cad']):
-             p = d['priority'][i]
-             if c and p in self.cadences:
-                 if c >= self.cadences[p]:
-                    d['observe'].append('Y')
-                 else:
-                    d['observe'].append('N')
-             else:
-                 d['observe'].append('-')
+         d['observe'] = self.observeFlags(d['cad'], d['priority'])
 
       # Set colors
-      d['color'] = []
-      for t in d['Tags']:
-          if t.find('Standard') >= 0:
-              d['color'].append("orange")
-          else:
-              d['color'].append("blue")
+      d['color'] = np.where(np.char.find(np.asarray(d['Tags'], dtype=str),
+                            'Standard') >= 0, "orange", "blue")
+
+      # Strings go in as lists:  patches write into the source's columns in
+      # place, and fixed-width numpy strings would truncate longer values
+      for key,col in d.items():
+         if isinstance(col, np.ndarray) and col.dtype.kind in 'US':
+            d[key] = col.tolist()
          
-      if self.source is not None:
+      if self.source is not None and list(self.source.data['ID']) == \
+            list(d['ID']) and set(self.source.data) == set(d):
+         # Same targets (e.g., a refreshed queue):  only send what changed.
+         # Flushed right away, since the filter index below is built from
+         # the source.
+         self.updateColumns(d)
+         self.flushColumns()
+      elif self.source is not None:
+         # Queued updates are for the old targets
+         self.pending = {}
          self.source.data = d
       else:
          self.source = ColumnDataSource(d)
 
+      self.makeFilterIndex()
       booleans = np.ones((len(d['Name'])), dtype=bool)
       if self.view is not None:
          self.view.filter.booleans = booleans
       else:
          self.view = CDSView(filter=BooleanFilter(booleans=booleans))
 
+      self.timeSlider.start = self.data['times'][0].unix*1000
+      self.timeSlider.end = self.data['times'][-1].unix*1000
+      self.timeSlider.value = min(max(self.now['now'].unix*1000, 
+                           self.timeSlider.start), self.timeSlider.end)
+      if not self.liveTime.active:
+         # New data are always shown at the current time
+         self.liveTime.active = [0]
+
       tags = list(set([tag for tag in self.data['comm'] if tag]))
       if len(tags) > 0:
          self.tagSelector.options = tags
@@ -300,12 +525,19 @@ class ObjectData:
       else:
          self.tagSelector.visible = False
 
-   def fetchQueue(self):
+   def refreshQueue(self):
+      '''Re-query the database, bypassing the shared queue cache'''
+      self.fetchQueue(force=True)
+
+   def fetchQueue(self, force=False):
       query.PASS= self.CSPpasswd.value
+      queue = self.QSTRS[self.dataSource.value]
       try:
-         self.data = query.qData(self.QSTRS[self.dataSource.value])
+         self.data = query.getQueue(queue, force=force)
+         age = query.queueCache.age(queue)
          self.dataSourceMessage.text = "<font color='darkgreen'>"\
-            "Retreived {} targets</font>".format(self.data['N'])
+            "Retreived {} targets ({:.0f}s old)</font>".format(self.data['N'],
+                                                              age)
          self.dataSourceMessage.visible = True
       except:
          self.dataSourceMessage.text = "<font color='red'>Query failed</font>"
@@ -319,25 +551,90 @@ class ObjectData:
       self.prioritySelect.visible = True
       self.observeSelector.visible = True
       self.data = computeNightQuantities(self.data)
-      self.now = computeCurrentQuantities(self.data['targets']) 
+      self.now = self.currentQuantities()
       self.makeDataSource()
       self.table.columns[1].formatter = HTMLTemplateFormatter(template=\
          '<a href="https://csp.lco.cl/sn/sn.php?sn=<%= value %>" '\
          'target="_SN"><%= value %></a>')
       self.table.columns[-1].visible=True
 
-   def uploadCatalog(self, attr, old, new):
+   def syncQueue(self):
+      '''Incremental refresh of a POISE queue: only the targets whose
+      photometry, priority or cadence changed since the last fetch are
+      re-queried, and only their rows are patched in the ColumnDataSource.
+      Falls back to a full fetchQueue() if targets were added, removed or
+      moved.'''
+      if self.dataSource.value not in self.QSTRS or 'marks' not in self.data:
+         return
+      query.PASS= self.CSPpasswd.value
+      queue = self.QSTRS[self.dataSource.value]
       try:
-         self.data = readMagCat(base64.b64decode(new))
-         self.dataSourceMessage.text = "<font color='darkgreen'>"\
-            "Uploaded {} targets</font>".format(self.data['N'])
-         self.dataSourceMessage.visible = True
+         marks,members,new = query.syncQueue(queue, self.data['marks'])
       except:
-         self.dataSourceMessage.text = "<font color='red'>Upload failed</font>"
+         self.dataSourceMessage.text = "<font color='red'>Sync failed</font>"
          self.dataSourceMessage.visible = True
+         print(traceback.format_exc())
          return
-      self.data = computeNightQuantities(self.data)
-      self.now = computeCurrentQuantities(self.data['targets'])
+
+      current = [SNID for SNID,p in zip(self.data['SNID'],
+                 self.data['priority']) if p != 'Standard']
+      if set(members) != set(current):
+         self.fetchQueue(force=True)
+         return
+      self.data['marks'] = marks
+      if new is None:
+         return
+
+      rows = dict([(SNID,i) for i,SNID in enumerate(self.data['SNID'])])
+      idx = [rows[SNID] for SNID in new['SNID']]
+      for j,i in enumerate(idx):
+         if new['RA'][j] != self.data['RA'][i] or \
+               new['DE'][j] != self.data['DE'][i]:
+            # Need to re-compute the night quantities
+            self.fetchQueue(force=True)
+            return
+      self.data.setRows(idx, new, skip=['ID'])
+
+      age,cad = self.ageCadence()
+      patches = dict(
+         priority=[(i,self.data['priority'][i]) for i in idx],
+         camp=[(i,self.data['camp'][i]) for i in idx],
+         Tags=[(i,self.data['comm'][i]) for i in idx])
+      if age is not None:
+         patches['age'] = [(i,age[i]) for i in idx]
+      if cad is not None:
+         patches['cad'] = [(i,cad[i]) for i in idx]
+      if 'observe' in self.source.data:
+         observe = self.observeFlags(cad, self.data['priority'])
+         patches['observe'] = [(i,observe[i]) for i in idx]
+      self.source.patch(patches)
+      self.makeFilterIndex()
+      self.updateViewFilter(None, None, None)
+      self.dataSourceMessage.text = "<font color='darkgreen'>"\
+            "Updated {} targets</font>".format(len(idx))
+      self.dataSourceMessage.visible = True
+
+   def uploadCatalog(self, attr, old, new):
+      content = base64.b64decode(new)
+      # Keyed by the night computeNightQuantities() shows (the coming one
+      # once the sun is up), for the same date
+      date = Time.now()
+      key = catalogCache.key(content, makeTimeRange(date)['night'])
+      data = catalogCache.get(key)
+      if data is None:
+         try:
+            data = readMagCat(content)
+         except:
+            self.dataSourceMessage.text = "<font color='red'>Upload failed</font>"
+            self.dataSourceMessage.visible = True
+            return
+         data = computeNightQuantities(data, date)
+         catalogCache.put(key, data)
+      self.data = data
+      self.dataSourceMessage.text = "<font color='darkgreen'>"\
+         "Uploaded {} targets</font>".format(self.data['N'])
+      self.dataSourceMessage.visible = True
+      self.now = self.currentQuantities()
       self.makeDataSource()
       self.table.source = self.source
       if "observe" in self.source.data:
@@ -372,7 +669,7 @@ class ObjectData:
       columns = [
            TableColumn(field="label", title="Quantity", width=20),
            TableColumn(field="value", title="Value", width=50)]
-      nightdata = computeNightParams()
+      nightdata = dict(sharedCache.nightParams())
 
       table = DataTable(source=ColumnDataSource(data=nightdata),
                columns=columns, width=500, height=500)
@@ -1,19 +1,100 @@
 from bokeh.layouts import layout,column
 from bokeh.plotting import figure,curdoc
-from .query import qData, getLCOsky
+from .query import qData, SKY_TIMEOUT
 from .data import ObjectData
-from .compute import computeCurrentQuantities,computeTimes
-from .plot_skyview_bokeh import SkyMap
+from .compute import computeCurrentQuantities,clock,siteContext,getObserver,\
+                     currentContext
+from .plot_skyview_bokeh import SkyMap,conAltAz
+from .shared import sharedCache
+from .scheduler import scheduler
 from bokeh.plotting import figure
 from bokeh.models import Range1d, Button, LinearAxis, Span,\
                          HoverTool, TabPanel, Tabs, CustomJS,\
-                         TapTool,ColumnDataSource, CustomJSHover
+                         TapTool,ColumnDataSource, CustomJSHover, Div,\
+                         Slider, CustomJSTickFormatter
 from bokeh.models.css import InlineStyleSheet
 from bokeh.models.tickers import FixedTicker
+from bokeh.events import DocumentReady
+from bokeh.transform import transform
 import numpy as np
+import time
+import os
 
 # Global settings
 SERVERLOC="local"
+AUTO_REFRESH=5*60000     # Period of POISE queue auto-refresh (ms)
+# Update the clocks and target positions in the browser rather than
+# pushing them from the server
+CLIENT_UPDATES = os.environ.get('MAGDASH_CLIENT_UPDATES', '0') == '1'
+CLIENT_RESYNC = 10*60    # In that mode, the server's positions are sent
+                         # this often (s)
+SKY_STALE = 10*60        # Sky image older than this (s) is flagged
+# Where bokeh serves the app's static directory (bokeh serve magDash)
+STATIC_URL = os.environ.get('MAGDASH_STATIC_URL', '/magDash/static')
+
+# Runs in the browser when CLIENT_UPDATES is set. LST is a linear model 
+# anchored on the server's clock. The browser's clock is only used for
+# elapsed time:  its offset from the server's (t0, the server time when the
+# page was made, so the offset is off by the page's load time) is applied
+# to all times. Changes are made with sync: false (and in-place on the 
+# source) so nothing is sent back to the server:  the server's source.data
+# falls behind what the browser shows, until the server sends its own
+# positions (every CLIENT_RESYNC seconds, or when the data change).
+clientJS = '''
+const rate = 1.00273790935
+const offset = t0 - Date.now()
+function serverNow() {
+   return Date.now() + offset
+}
+function lst(ms) {
+   return (((lst0 + (ms - t0)/3.6e6*rate) % 24) + 24) % 24
+}
+function hms(h) {
+   const s = Math.round(h*3600) % 86400
+   const f = (x) => String(x).padStart(2, '0')
+   return f(Math.floor(s/3600))+":"+f(Math.floor(s/60) % 60)+":"+f(s % 60)
+}
+function clocks() {
+   const now = serverNow()
+   const d = new Date(now)
+   UT.setv({label: "UT: "+d.toISOString().substring(11,19)}, {sync: false})
+   LT.setv({label: "LT: "+d.toLocaleTimeString('en-GB', 
+      {timeZone: tz, hour12: false})}, {sync: false})
+   ST.setv({label: "ST: "+hms(lst(now))}, {sync: false})
+}
+function positions() {
+   if (live.active.length == 0) return
+   const now = serverNow()
+   const st = lst(now)
+   const d = source.data
+   const rad = Math.PI/180
+   const slat = Math.sin(lat*rad)
+   const clat = Math.cos(lat*rad)
+   for (let i = 0 ; i < d.RAd.length ; ++i) {
+      const H = (st - d.RAd[i])*15*rad
+      const sde = Math.sin(d.DEd[i]*rad)
+      const cde = Math.cos(d.DEd[i]*rad)
+      const alt = Math.asin(sde*slat + cde*clat*Math.cos(H))/rad
+      let az = Math.atan2(-cde*Math.sin(H), sde*clat - cde*slat*Math.cos(H))
+      if (az < 0) az += 2*Math.PI
+      const nh = alt > 0 ? alt : 0.001
+      const arg = nh + 244/(165 + 47*Math.pow(nh, 1.1))
+      d.alt[i] = alt
+      d.zang[i] = 90 - alt
+      d.az[i] = az
+      d.AM[i] = 1/Math.sin(arg*rad)
+      d.HA[i] = d.RA[i] - st
+   }
+   source.change.emit()
+   vline.setv({location: now}, {sync: false})
+   slider.setv({value: Math.min(Math.max(now, slider.start), slider.end)},
+               {sync: false})
+}
+clocks()
+positions()
+setInterval(clocks, 1000)
+setInterval(positions, 60000)
+'''
 
 infoBtn_css = InlineStyleSheet(css=\
 '''
@@ -35,32 +116,87 @@ def Update1s():
    # stuff to do each second
    global UT,ST,LT
 
-   ut,lt,st = computeTimes()
+   ut,lt,st = clock.strings()
    UT.label = "UT: "+ut
    ST.label = "ST: "+st
    LT.label = "LT: "+lt
 
 
-def Update1m():
-   # stuff to do every minute
-   global data, AMvline, LCOsky, skyplot
-   data.now = computeCurrentQuantities(data.data['targets'])
-   data.source.data['HA'] = data.now['HA']
-   data.source.data['AM'] = data.now['AM']
-   data.source.data['zang'] = data.now['zang']
-   data.source.data['az'] = data.now['az']*np.pi/180
-   data.source.data['alt'] = data.now['alt']
-   #print(data.now['now'].datetime)
-   AMvline.location = data.now['now'].datetime
-   img = getLCOsky()
-   LCOsky.data['image'] = [img]
-   skyplot.computeConAltAz()
+# The per-minute updates are driven by the shared scheduler, which does
+# the work common to all sessions once and then calls these in each session
+def SkyStatus(sky):
+   '''HTML for the sky image status (age, or why it couldn't be fetched)'''
+   if sky['image'] is None:
+      text = "<font color='red'>No sky image"
+   else:
+      color = 'darkgreen' if sky['age'] < SKY_STALE else 'darkorange'
+      text = "<font color='{}'>Sky image: {} UT ({:.0f} min old)".format(
+         color, time.strftime("%H:%M", time.gmtime(sky['time'])),
+         sky['age']/60)
+   if sky['error'] is not None:
+      text += " (fetch failed: {})".format(sky['error'][:60])
+   return text+"</font>"
+
+
+def SkyFrames(sky):
+   '''The (versioned) URLs and times (ms) of the sky frames, oldest first'''
+   frames = sky['frames']
+   if frames is None:
+      return dict(url=[], t=[])
+   return dict(url=["{}/{}?v={}".format(STATIC_URL, f, v) for f,v in 
+                    zip(frames['file'], frames['version'])],
+               t=[t*1000 for t in frames['time']])
+
+
+def UpdateSky(sky):
+   global LCOsky, skyFrames, replaySlider, skyStatus
+   skyStatus.text = SkyStatus(sky)
+   # Only the URLs are sent, and only when there is a new frame
+   frames = SkyFrames(sky)
+   if frames['url'] == skyFrames.data['url']:
+      return
+   old = skyFrames.data['t']
+   n = len(frames['url'])
+   if replaySlider.value >= len(old) - 1 or n == 0:
+      # Follow the latest frame
+      i = n - 1
+   else:
+      # Stay on the frame being looked at
+      i = int(np.searchsorted(frames['t'], old[replaySlider.value]))
+      i = min(i, n - 1)
+   skyFrames.data = frames
+   replaySlider.update(end=max(n-1, 1), value=max(i, 0), disabled=n < 2)
+   LCOsky.data = dict(url=frames['url'][i:i+1])
+
+
+def UpdateConLines(altaz):
+   global skyplot
+   skyplot.setConAltAz(altaz)
+
+
+def UpdateStars(context=None):
+   global skyplot
+   skyplot.setStars(None if context is None else context['now'].unix)
+
+
+def UpdatePositions(context=None):
+   global data
+   # Not if the user is looking at another time
+   if data.liveTime.active:
+      data.updateNow(context=context)
+
+
+def UpdateQueue():
+   # incremental refresh of the POISE queue, if requested
+   global data
+   if data.autoRefresh.active:
+      data.syncQueue()
 
 
 def FilterCallback():
    global data
-   newbools = np.array([i in data.source.selected.indices for i in \
-                        range(len(data.source.data['Name']))])
+   newbools = np.zeros(len(data.source.data['Name']), dtype=bool)
+   newbools[data.source.selected.indices] = True
    if not np.any(newbools): return
    data.view.filter.booleans = data.view.filter.booleans & newbools
 
@@ -107,24 +243,47 @@ ax2 = LinearAxis(y_range_name="AM", ticker=FixedTicker(ticks=tickloc),
 ax2.major_label_overrides = {10:"5.76", 20:"2.92", 30:"2.20", 40:"1.56", 
         50:"1.31", 60:"1.15", 70:"1.06", 80:"1.02", 90:"1.00"}
 AMfig.add_layout(ax2, 'right')
-AMml = AMfig.multi_line(xs="times", ys="alts", source=data.source, 
-                        hover_color='red', line_color='color', view=data.view)
+AMml = AMfig.multi_line(xs=transform("alts", data.timeTransform), ys="alts",
+                        source=data.source, hover_color='red', 
+                        line_color='color', view=data.view)
 
 
 AMvline = Span(location=data.now['now'].datetime, dimension='height', 
         line_color='red', line_width=3)
 AMfig.add_layout(AMvline)
+# The time marker follows the time slider (in the browser)
+data.timeSlider.js_link('value', AMvline, 'location')
 AMhvr.renderers = [AMml]
 
 skyplot = SkyMap(imsize=500)
 skyplot.conLines()
+skyplot.stars()
 # Plot zenith-angle, since that's how polar plots work
 skyplot.plotTargets(data.source, 'zang', 'az', view=data.view,
                     marker='star', size=10, color='grey',fill_color='color')
-img = getLCOsky()
-LCOsky = ColumnDataSource(dict(image=[img]))
-skyplot.fig.figure.image_rgba(image='image',source=LCOsky, x=-1.088, y=-1.086, dw=2.16, dh=2.16,
-                              level='image')
+# Don't wait for the weather server:  use the last frame (or nothing) until
+# the scheduler gets a new one
+sky = sharedCache.skyImage()
+skyFrames = ColumnDataSource(SkyFrames(sky))
+nframes = len(skyFrames.data['url'])
+LCOsky = ColumnDataSource(dict(url=skyFrames.data['url'][-1:]))
+skyStatus = Div(text=SkyStatus(sky))
+skyplot.fig.figure.image_url(url='url', source=LCOsky, x=-1.088, y=-1.086, 
+                             w=2.16, h=2.16, anchor='bottom_left', 
+                             level='image')
+# Replay of the last frames (cloud motion). Done in the browser, which only
+# loads the frames that are looked at.
+replaySlider = Slider(start=0, end=max(nframes-1, 1), step=1, 
+      value=max(nframes-1, 0), title="Replay", disabled=nframes < 2,
+      format=CustomJSTickFormatter(args=dict(frames=skyFrames), code='''
+const t = frames.data.t[Math.round(tick)]
+return t === undefined ? "" : new Date(t).toISOString().substring(11,16)+" UT"
+'''))
+replaySlider.js_on_change('value', CustomJS(
+   args=dict(sky=LCOsky, frames=skyFrames), code='''
+const url = frames.data.url[cb_obj.value]
+if (url !== undefined) sky.setv({data: {url: [url]}}, {sync: false})
+'''))
 #skyplot.plotTargets(data.source, 'alt','az')
 tt = skyplot.fig.figure.select(type=TapTool)
 tt.renderers = skyplot.hover.renderers
@@ -139,7 +298,8 @@ window.open("https://csp.lco.cl/sn/sn.php?sn="+name,"_SN");
 
 tabs = Tabs(tabs=[
    TabPanel(child=AMfig, title='Airmass'),
-   TabPanel(child=skyplot.fig.figure, title='Sky'),
+   TabPanel(child=column(skyStatus, skyplot.fig.figure, replaySlider),
+            title='Sky'),
    TabPanel(child=night_table, title='Night Stats')
 ])
 
@@ -150,16 +310,39 @@ FilterResetButton.on_click(FilterReset)
 
 curdoc().add_root(layout(
    [[data.dataSource,data.magellanCatalog,data.CSPpasswd,data.CSPSubmit,
-        data.dataSourceMessage],
+        data.CSPRefresh,data.autoRefresh,data.dataSourceMessage],
     [LT,UT,ST],
     [table,tabs,column(
       data.RArange,data.DECrange,data.minAirmass,data.ageSlider,
       data.cadSlider, data.tagSelector,
-      data.campSelect,data.prioritySelect, data.observeSelector)
+      data.campSelect,data.prioritySelect, data.observeSelector,
+      data.timeSlider, data.liveTime)
       #data.ageSlider,data.campSelect,data.prioritySelect)
     ],
     [FilterButton,FilterResetButton]
    ]
 ))
-curdoc().add_periodic_callback(Update1s, 1000)
-curdoc().add_periodic_callback(Update1m, 60000)
+if CLIENT_UPDATES:
+   site = siteContext()
+   curdoc().js_on_event(DocumentReady, CustomJS(args=dict(
+      UT=UT, LT=LT, ST=ST, source=data.source, vline=AMvline, 
+      live=data.liveTime, slider=data.timeSlider,
+      lat=site['lat'].degree, tz="America/Santiago", lst0=clock.lst(), 
+      t0=time.time()*1000), code=clientJS))
+else:
+   curdoc().add_periodic_callback(Update1s, 1000)
+scheduler.addJob('sky', lambda: sharedCache.skyImage(wait=SKY_TIMEOUT,
+                                                     force=True), 60)
+scheduler.addJob('conlines', lambda: conAltAz(getObserver('LCO')), 60)
+scheduler.addJob('minute', currentContext, 60)
+doc = curdoc()
+scheduler.subscribe('sky', doc, UpdateSky)
+scheduler.subscribe('conlines', doc, UpdateConLines)
+scheduler.subscribe('minute', doc, UpdateStars)
+if not CLIENT_UPDATES:
+   scheduler.subscribe('minute', doc, UpdatePositions)
+else:
+   scheduler.addJob('resync', currentContext, CLIENT_RESYNC)
+   scheduler.subscribe('resync', doc, UpdatePositions)
+doc.on_session_destroyed(lambda session_context: scheduler.unsubscribe(doc))
+curdoc().add_periodic_callback(UpdateQueue, AUTO_REFRESH)
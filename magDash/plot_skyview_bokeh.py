@@ -5,39 +5,108 @@ advantage of embedding directly into the HTML canvas with a given size,
 making it easier to place than a matplotlib-generated image. Intractions
 are also much much better.'''
 
-import os
 from . import polar
 from bokeh.plotting import ColumnDataSource
 from bokeh.models import HoverTool, CustomJS, CDSView
 from bokeh.models.filters import BooleanFilter,AllIndices
+from bokeh.events import RangesUpdate
 import numpy as np
-import pickle
+import os
+from functools import cache
 
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
 from astropy.units import degree
 from astropy.time import Time
 import time
 from astroplan import Observer,FixedTarget
-
-
-
-# The constellation data.
-conlines = os.path.join(os.path.dirname(__file__), 'Conlines3.pkl')
-with open(conlines, 'rb') as f:
-   ra1s,ra2s,dec1s,dec2s = pickle.load(f)
-conCDS = ColumnDataSource(dict(
-   RA1=ra1s,
-   RA2=ra2s,
-   DEC1=dec1s,
-   DEC2=dec2s
-))
-
+from .compute import getObserver,precessionMatrix,siderealClock
+from .shared import sharedCache
+from .skyoverlay import loadOverlay,starIndex,STAR_TIERS
+
+# Faintest stars shown as the user zooms in:  (radius of the view in
+# degrees, faintest magnitude). Otherwise only the first tier is shown.
+STAR_ZOOM = ((35, STAR_TIERS[2]), (70, STAR_TIERS[1]))
+# Never send more than this many stars (the brightest are kept)
+MAX_STARS = int(os.environ.get('MAGDASH_MAX_STARS', 1000))
+
+
+
+def conVertices(ra1s, ra2s, dec1s, dec2s):
+   '''The unique vertices of the constellation lines as ICRS unit vectors
+   (3xV) and the vertex index of each end of the segments'''
+   N = len(ra1s)
+   ends = np.stack([np.concatenate([ra1s,ra2s]), 
+                    np.concatenate([dec1s,dec2s])], axis=1)
+   verts,idx = np.unique(ends, axis=0, return_inverse=True)
+   idx = idx.ravel()
+   ra,dec = np.radians(verts[:,0]),np.radians(verts[:,1])
+   vecs = np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), 
+                    np.sin(dec)])
+   return vecs,idx[:N],idx[N:]
+
+@cache
+def conSegments():
+   '''conVertices() of the constellation lines, computed on first use'''
+   con = loadOverlay('conlines')
+   return conVertices(con['ra1'], con['ra2'], con['dec1'], con['dec2'])
+
+
+def RAhDecd2AltAz(obs, date, RA, DEC):
+   '''Zenith angle (degrees) and azimuth (radians) of RA/DEC (degrees) as
+   seen by obs at date'''
+   radec = SkyCoord(RA, DEC, frame='icrs', unit=degree)
+   t = FixedTarget(radec)
+   altaz = obs.altaz(date, t)
+   return (90. - altaz.alt.to('degree').value, 
+           altaz.az.to('degree').value*np.pi/180.0)
+
+@cache
+def _precession(day):
+   # Changes by < 0.2 arcsec a day
+   return precessionMatrix(Time(day*86400., format='unix'))
+
+@cache
+def _latitude(location):
+   return getObserver(location).location.lat.radian
+
+def conMatrix(obs, unix):
+   '''The matrix that rotates ICRS unit vectors to (north, east, up) as 
+   seen by obs at unix time:  precession-nutation, then the local
+   (apparent) sidereal time, then the latitude. Aberration and refraction
+   are ignored (< 30 arcsec).'''
+   lst = siderealClock(obs.name).lst(unix)*np.pi/12
+   lat = _latitude(obs.name)
+   cl,sl = np.cos(lst),np.sin(lst)
+   cp,sp = np.cos(lat),np.sin(lat)
+   # to hour angle (x toward the meridian, y = -cos(dec)sin(HA))
+   HA = np.array([[cl, sl, 0], [-sl, cl, 0], [0, 0, 1]])
+   # to north, east, up
+   horizon = np.array([[-sp, 0, cp], [0, 1, 0], [cp, 0, sp]])
+   return horizon @ HA @ _precession(int(unix//86400))
+
+def projectConLines(obs, unix):
+   '''(alt1s, az1s, alt2s, az2s) of the constellation lines seen by obs at
+   unix time. The "alt"s are zenith angles (degrees), the azimuths are in
+   radians. Each vertex is rotated once, then gathered into the segments.'''
+   vecs,con1,con2 = conSegments()
+   n,e,u = conMatrix(obs, unix) @ vecs
+   zang = 90. - np.degrees(np.arcsin(np.clip(u, -1, 1)))
+   az = np.mod(np.arctan2(e, n), 2*np.pi)
+   return zang[con1],az[con1],zang[con2],az[con2]
+
+def conAltAz(obs, date=None):
+   '''projectConLines() at date (default: now), computed once a minute in
+   the shared cache'''
+   unix = time.time() if date is None else Time(date).unix
+   return sharedCache.get(('conlines',obs.name), 
+                          lambda: projectConLines(obs, unix), 
+                          tag=int(unix//60))
 
 class SkyMap:
 
    def __init__(self, location='LCO', date=None, imsize=400):
 
-      self.obs = Observer.at_site(location)
+      self.obs = getObserver(location)
       if date is None:
          self.date = Time.now()
       else:
@@ -45,12 +114,8 @@ class SkyMap:
       self.imsize = imsize
       self._setup()
 
-      self.conCDS = ColumnDataSource(dict(
-         RA1=ra1s,
-         RA2=ra2s,
-         DEC1=dec1s,
-         DEC2=dec2s
-      ))
+      # Only the alt/az of the lines (see setConAltAz) go to the browser
+      self.conCDS = ColumnDataSource(dict(alt1=[], alt2=[], az1=[], az2=[]))
       # Initial filtered view
       self.conView = CDSView(filter=AllIndices())
                 
@@ -73,19 +138,19 @@ class SkyMap:
       '''Given an RA/DEC of a constallation vertex, return alt/Az on the sky.
       We let polar.py deal with converting to x,y on the screen. If the vertex
       is below the horizon, set clip=True'''
-      radec = SkyCoord(RA, DEC, frame='icrs', unit=degree)
-      t = FixedTarget(radec)
-      altaz = self.obs.altaz(self.date, t)
-      return (90. - altaz.alt.to('degree').value, 
-              altaz.az.to('degree').value*np.pi/180.0)
-
-   def computeConAltAz(self):
-      alt1s,az1s = self.RAhDecd2AltAz(ra1s, dec1s)
-      alt2s,az2s = self.RAhDecd2AltAz(ra2s, dec2s,)
-      self.conCDS.data['alt1'] = alt1s
-      self.conCDS.data['alt2'] = alt2s
-      self.conCDS.data['az1'] = az1s
-      self.conCDS.data['az2'] = az2s
+      return RAhDecd2AltAz(self.obs, self.date, RA, DEC)
+
+   def computeConAltAz(self, date=None):
+      '''Alt/az of the constellation lines at date (default: now). These are
+      the same for all sessions, so they are computed once a minute in the
+      shared cache.'''
+      self.date = Time.now() if date is None else Time(date)
+      self.setConAltAz(conAltAz(self.obs, self.date))
+
+   def setConAltAz(self, altaz):
+      '''Show the constellation lines at altaz (from conAltAz())'''
+      alt1s,az1s,alt2s,az2s = altaz
+      self.conCDS.data.update(alt1=alt1s, alt2=alt2s, az1=az1s, az2=az2s)
       booleans = np.less(alt1s,self.rmax) & np.less(alt2s,self.rmax)
       self.conView.filter = BooleanFilter(booleans=booleans)
 
@@ -97,6 +162,56 @@ class SkyMap:
                   view=self.conView, line_color='gray', line_width=0.5)
      
 
+   def stars(self):
+      '''Plot the bright stars. Only those above the horizon and in view are
+      sent, the fainter tiers as the user zooms in (see setStars).'''
+      self.starCDS = ColumnDataSource(dict(zang=[], az=[], size=[]))
+      self.starView = None
+      self.setStars()
+      self.fig.scatter('zang', 'az', source=self.starCDS, size='size',
+                       line_color='gray', line_width=0.5, 
+                       fill_color='lightyellow')
+      self.fig.figure.on_event(RangesUpdate, lambda event: self.setStars(
+         view=(event.x0, event.x1, event.y0, event.y1)))
+
+   def viewCap(self, view):
+      '''Center (unit vector in north, east, up) and radius (degrees) of a
+      circle on the sky holding the view (x0, x1, y0, y1) of the plot'''
+      x0,x1,y0,y1 = view
+      xc,yc = (x0 + x1)/2,(y0 + y1)/2
+      zang = np.radians(np.hypot(xc, yc)*self.rmax)
+      az = self.fig.theta0 + [1,-1][self.fig.clockwise]*np.arctan2(yc, xc)
+      center = np.array([np.sin(zang)*np.cos(az), np.sin(zang)*np.sin(az),
+                         np.cos(zang)])
+      # Plot distances are never less than the true ones
+      return center,np.hypot(x1 - x0, y1 - y0)/2*self.rmax
+
+   def setStars(self, unix=None, view=None):
+      '''Show the stars at unix time (default: now) in view (x0, x1, y0, y1;
+      default: the last one)'''
+      unix = time.time() if unix is None else unix
+      if view is not None:
+         self.starView = view
+      elif self.starView is None:
+         xr,yr = self.fig.figure.x_range,self.fig.figure.y_range
+         self.starView = (xr.start, xr.end, yr.start, yr.end)
+      center,radius = self.viewCap(self.starView)
+      maglim = STAR_TIERS[0]
+      for r,mag in STAR_ZOOM:
+         if radius <= r:
+            maglim = mag
+            break
+      M = conMatrix(self.obs, unix)
+      index = starIndex()
+      idx = index.query(M.T @ center, np.radians(radius), maglim)
+      n,e,u = M @ index.vecs[:,idx]
+      # The brightest come first
+      up = np.nonzero(u > 0)[0][:MAX_STARS]
+      n,e,u,mag = n[up],e[up],u[up],index.mag[idx[up]]
+      zang = 90. - np.degrees(np.arcsin(np.minimum(u, 1)))
+      self.starCDS.data = dict(zang=zang, az=np.mod(np.arctan2(e, n), 2*np.pi),
+                               size=np.clip(7.5 - mag, 1.5, 8))
+
    def plotTargets(self, source, alt, az, view=None, **kwargs):
       '''Plots the objects for a given night for the given objects located in
       the CDS source. alt and az must correspond to altitude and azimuth'''
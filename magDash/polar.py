@@ -173,11 +173,8 @@ if __name__ == '__main__':
     from bokeh.models import HoverTool
     from bokeh.models import ImageURL
     from PIL import Image
-    import pickle
     import numpy as np
 
-    f = open('Conlines3.pkl','rb')
-    d = pickle.load(f)
     output_file("polar.html")
 
     angles = np.random.uniform(0,2*np.pi, size=100)
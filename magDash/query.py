@@ -12,10 +12,21 @@ from astropy import units as u
 from astroplan import Observer, FixedTarget
 from astropy.time import Time
 import numpy as np
-from OptStandards import addStandards
+from .OptStandards import addStandards
+from .targettable import TargetTable
+from .skyring import FrameRing
 from functools import cache
+from contextlib import contextmanager
 import datetime
 import os
+import time
+import copy
+import hashlib
+import threading
+import io
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from email.utils import parsedate_to_datetime
 import requests
 from bs4 import BeautifulSoup
 import re
@@ -30,6 +41,26 @@ if 'CSPpasswd' in os.environ:
 
 DB='Phot'
 
+# Persistent connections kept around per process and how long (seconds) a
+# fetched queue is served from memory before going back to the database.
+POOL_SIZE = 4
+QUEUE_TTL = float(os.environ.get('MAGDASH_QUEUE_TTL', 120))
+
+# The LCO all-sky camera:  where the latest image is, how long (seconds) to
+# wait for it and how long a fetched image is good for before checking for
+# a new one.
+SKY_URL = os.environ.get('MAGDASH_SKY_URL', 
+                  'https://weather-dev.lco.cl/media/casca/red/latestimage.jpeg')
+SKY_TIMEOUT = float(os.environ.get('MAGDASH_SKY_TIMEOUT', 10))
+SKY_TTL = float(os.environ.get('MAGDASH_SKY_TTL', 60))
+# Images are downsampled to at most this many pixels on a side (the size
+# of the SkyMap in main.py), 0 to keep the full resolution
+SKY_SIZE = int(os.environ.get('MAGDASH_SKY_SIZE', 500))
+# The frames are saved here (the app's static directory, served by bokeh
+# at /magDash/static/) for the browsers to load
+SKY_STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                          'static')
+
 target_pat = re.compile(r'target:"([^"]+)"')
 
 def airmass(h):
@@ -64,6 +95,40 @@ cad_query = '''
 SELECT UT FROM obs_log WHERE SN=%s and MD=%s
 ORDER BY UT DESC LIMIT 1'''
 
+# Set-based versions of the above: latest priority comment and latest obs_log
+# UT for every target in the queue, in one round trip each.
+priorities_query = '''
+select t1.sn_id,t1.text from (
+   select sn_id,text,ROW_NUMBER() OVER (PARTITION BY sn_id
+      ORDER BY time DESC) as rn from comments where type="priority") as t1
+   join (select SNID from SNList WHERE {} = "1" {}) t0 on (t0.SNID=t1.sn_id)
+WHERE t1.rn=1'''
+
+cads_query = '''
+select t1.SN,max(t1.UT) from obs_log t1 join (
+   select SN from SNList WHERE {} = "1" {}) t0 on (t0.SN=t1.SN)
+WHERE t1.MD="{}" group by t1.SN'''
+# High-water marks of the tables that feed a queue: latest photometry,
+# latest observation and latest priority comment.
+marks_query = '''
+select (select max(jd) from MAGSN where filt="r" and obj<1),
+       (select max(UT) from obs_log where MD="{}"),
+       (select max(time) from comments where type="priority")'''
+
+members_query = '''
+select SNID from SNList WHERE {} = "1" {}'''
+
+# Targets in the queue with photometry, obs_log or priority newer than the
+# high-water marks
+changed_query = '''
+select t0.SNID from SNList t0 WHERE {} = "1" {} and (
+   exists (select 1 from MAGSN t1 where t1.filt="r" and t1.obj<1 
+      and t1.jd>%s and t1.field in 
+         (t0.SN,t0.NAME_CSP,t0.NAME_IAU,t0.NAME_PSN)) or
+   exists (select 1 from obs_log t2 where t2.MD="{}" and t2.UT>%s
+      and t2.SN=t0.SN) or
+   exists (select 1 from comments t3 where t3.type="priority" 
+      and t3.time>%s and t3.sn_id=t0.SNID))'''
 
 Q_names = ['SNID','SN','type','RA','DE','zc','zcmb','zvrb','dmag','host',
    'offew','offns','gtype','comm','survey','active','camp','agerdate',
@@ -94,79 +159,433 @@ def camp_str(camp):
       return CAMPS[idx]
 
 
-def qData(queue='QSWO'):
-   db = pymysql.connect(host=HOST, user=USER, passwd=PASS, db=DB)
+def connect():
+   '''Open a connection to the CSP/POISE database'''
+   # autocommit so that a pooled connection does not keep reading from the
+   # snapshot of its first transaction
+   return pymysql.connect(host=HOST, user=USER, passwd=PASS, db=DB,
+                          autocommit=True)
+
+def _passwdKey():
+   return hashlib.sha256(PASS.encode()).hexdigest()
+
+class ConnectionPool:
+   '''A process-wide pool of persistent database connections. Connections
+   are checked with ping() before re-use and dropped when PASS changes.'''
+
+   def __init__(self, size=POOL_SIZE):
+      self.size = size
+      self.idle = []
+      self.key = None
+      self.lock = threading.Lock()
+
+   def get(self):
+      with self.lock:
+         if self.key != _passwdKey():
+            self.flush()
+            self.key = _passwdKey()
+         db = self.idle.pop() if self.idle else None
+      if db is not None:
+         try:
+            db.ping(reconnect=True)
+            return db
+         except Exception:
+            self._close(db)
+      return connect()
+
+   def put(self, db):
+      with self.lock:
+         if len(self.idle) < self.size and self.key == _passwdKey():
+            self.idle.append(db)
+            return
+      self._close(db)
+
+   def flush(self):
+      '''Close all idle connections'''
+      while self.idle:
+         self._close(self.idle.pop())
+
+   def _close(self, db):
+      try:
+         db.close()
+      except Exception:
+         pass
+
+   @contextmanager
+   def connection(self):
+      '''Borrow a connection for the duration of a with block'''
+      db = self.get()
+      try:
+         yield db
+      except Exception:
+         self._close(db)
+         raise
+      self.put(db)
+
+class QueueCache:
+   '''Per-queue cache of qData() results, shared by all sessions. Entries
+   expire after ttl seconds and are only served to sessions that supplied
+   the same password that was used to fetch them.'''
+
+   def __init__(self, ttl=QUEUE_TTL):
+      self.ttl = ttl
+      self.entries = {}
+      self.locks = {}
+      self.lock = threading.Lock()
+
+   def queueLock(self, queue):
+      '''Lock held while a queue is fetched, so that concurrent sessions
+      wait for one query instead of each running their own'''
+      with self.lock:
+         return self.locks.setdefault(queue, threading.Lock())
+
+   def get(self, queue):
+      entry = self.entries.get(queue, None)
+      if entry is None: return None
+      t,key,data = entry
+      if time.time() - t > self.ttl or key != _passwdKey():
+         return None
+      return copy.deepcopy(data)
+
+   def put(self, queue, data):
+      self.entries[queue] = (time.time(), _passwdKey(), copy.deepcopy(data))
+
+   def age(self, queue):
+      '''Seconds since queue was fetched, None if not cached'''
+      if queue not in self.entries: return None
+      return time.time() - self.entries[queue][0]
+
+   def invalidate(self, queue=None):
+      '''Drop the cached queue (or all queues if None)'''
+      if queue is None:
+         self.entries.clear()
+      else:
+         self.entries.pop(queue, None)
+
+pool = ConnectionPool()
+queueCache = QueueCache()
+
+def getQueue(queue='QSWO', force=False):
+   '''Get the targets in a POISE queue, served from queueCache if it was
+   fetched less than QUEUE_TTL seconds ago. force=True always re-queries the
+   database. Returns a private copy that the caller may modify.'''
+   with queueCache.queueLock(queue):
+      if not force:
+         data = queueCache.get(queue)
+         if data is not None:
+            return data
+      with pool.connection() as db:
+         data = qData(queue, db=db)
+      queueCache.put(queue, data)
+   return data
+
+def qMarks(c, queue):
+   '''Current high-water marks (jd, ut, time) for queue'''
+   c.execute(marks_query.format(OBS_Names[queue]))
+   jd,ut,t = c.fetchall()[0]
+   return dict(jd=jd if jd else 0, ut=ut if ut else 0, time=t if t else 0)
+
+def qPriorities(c, queue, SNIDs, where=None, args=()):
+   '''Latest priority comment for each of SNIDs using one set-based query.
+   Targets without a priority comment get "Unknown"'''
+   if where is None: where = WHERES[queue]
+   c.execute(priorities_query.format(queue, where), args)
+   lookup = dict(c.fetchall())
+   return [lookup.get(SNID, "Unknown") for SNID in SNIDs]
+
+def qCadences(c, queue, names, where=None, args=()):
+   '''JD of the latest obs_log entry for each of names using one set-based
+   query. Targets never observed get -1'''
+   if where is None: where = WHERES[queue]
+   c.execute(cads_query.format(queue, where, OBS_Names[queue]), args)
+   lookup = dict(c.fetchall())
+   uts = [lookup.get(name, None) for name in names]
+   jdcads = np.ones(len(uts))*-1
+   idx = [i for i,ut in enumerate(uts) if ut is not None]
+   if idx:
+      jdcads[idx] = Time([uts[i] for i in idx]).jd
+   return jdcads
+
+def qData(queue='QSWO', db=None, batched=True, only=None):
+   '''Retrieve the targets in POISE queue from the CSP database.
+
+   Args:
+      queue(str):  one of QSWO, QWFCCD, QFIRE
+      db(connection):  an open DB-API connection. Default: connect()
+      batched(bool):  If True, get priorities and cadences with set-based
+                      queries, otherwise one query per target (slow)
+      only(list):  If given, only retrieve these SNIDs (no standards or
+                   high-water marks are added)
+
+   Returns:
+      TargetTable'''
+   close = db is None
+   if db is None:
+      db = connect()
    c = db.cursor()
-   #print(Q_query.format(OBS_Names[queue],queue,WHERES[queue]))
-   N = c.execute(Q_query.format(OBS_Names[queue],queue,WHERES[queue]))
+   where = WHERES[queue]
+   args = ()
+   if only is None:
+      # Marks first, so that anything changing during the fetch is picked
+      # up by the next syncQueue()
+      marks = qMarks(c, queue)
+   else:
+      where += 'and SNID in ({}) '.format(','.join(['%s']*len(only)))
+      args = tuple(only)
+   #print(Q_query.format(OBS_Names[queue],queue,where))
+   c.execute(Q_query.format(OBS_Names[queue],queue,where), args)
    rows = c.fetchall()
-   data = {}.fromkeys(Q_names)
-   for i,name in enumerate(Q_names):
-      data[name] = [row[i] for row in rows]
+   N = len(rows)
+   data = TargetTable(dict(zip(Q_names, 
+                     zip(*rows) if rows else [()]*len(Q_names))))
 
    # Rename SN to Name, for for generic tool
-   data['Name'] = data['SN']*1
+   data.addColumn('Name', data['SN'].copy())
    if queue=='QWFCCD':
-      data['ID'] = ["1{:02d}".format(i) for i in range(1,N+1)]
+      data.addColumn('ID', np.char.mod("1%02d", np.arange(1,N+1)))
    elif queue=='QFIRE':
-      data['ID'] = ["0{:02d}".format(i) for i in range(1,N+1)]
+      data.addColumn('ID', np.char.mod("0%02d", np.arange(1,N+1)))
    else:
-      data['ID'] = [str(i) for i in range(1,N+1)]
-   data['comm'] = [typ if typ else "unknown" for typ in data['type']]
-   # Convert to strings
-   data['camp'] = [camp_str(camp) for camp in data['camp']]
-
-   priorities = []
-   jdcads = []
-   mags = []
-   for SN in data['SNID']:
-      NN = c.execute(priority_query, (SN,))
-      if NN == 1:
-         priorities.append(c.fetchone()[0])
-      else:
-         priorities.append("Unknown")
-   data['priority'] = priorities
-   for name in data['SN']: 
-      MD = 'Opt'
-      if queue=='QWFCCD': MD='Spe'
-      if queue=='FIRE': MD='Isp'
-      NN = c.execute(cad_query, (name,MD))
-      if NN == 1:
-         ut = c.fetchone()[0]
-         jd = Time(ut).jd
-         jdcads.append(jd)
-      else:
-         jdcads.append(-1)
-   data['jdcad'] = jdcads
+      data.addColumn('ID', np.arange(1,N+1).astype(str))
+   data.addColumn('comm', [typ if typ else "unknown" for typ in data['type']])
+   # Convert to strings (once per campaign)
+   camps,codes = np.unique(data['camp'], return_inverse=True)
+   data.addColumn('camp', 
+         np.array([camp_str(camp) for camp in camps], dtype=str)[codes])
 
-   if queue=='QWFCCD' or queue=='QSWO':
+   if batched:
+      data.addColumn('priority', 
+                     qPriorities(c, queue, data['SNID'], where, args))
+      data.addColumn('jdcad', qCadences(c, queue, data['SN'], where, args))
+   else:
+      priorities = []
+      jdcads = []
+      for SN in data['SNID'].tolist():
+         NN = c.execute(priority_query, (SN,))
+         if NN == 1:
+            priorities.append(c.fetchone()[0])
+         else:
+            priorities.append("Unknown")
+      data.addColumn('priority', priorities)
+      for name in data['SN'].tolist(): 
+         MD = 'Opt'
+         if queue=='QWFCCD': MD='Spe'
+         if queue=='FIRE': MD='Isp'
+         NN = c.execute(cad_query, (name,MD))
+         if NN == 1:
+            ut = c.fetchone()[0]
+            jd = Time(ut).jd
+            jdcads.append(jd)
+         else:
+            jdcads.append(-1)
+      data.addColumn('jdcad', jdcads)
+
+   if only is None and (queue=='QWFCCD' or queue=='QSWO'):
       addStandards(data, queue)
    # Handle cases where not observed yet or is a standard
-   data['utobs'] = [ut if ut else '2000-01-01' for ut in data['utobs']]
-   db.close()
+   data.addColumn('utobs', 
+                  [ut if ut else '2000-01-01' for ut in data['utobs']])
+   if close:
+      db.close()
    data['N'] = N
+   if only is None:
+      data['marks'] = marks
 
    return data
 
-def getLCOsky(format='bokeh'):
+def qChanged(c, queue, marks):
+   '''Given high-water marks from a previous fetch, find the current
+   members of queue and the SNIDs that changed since.'''
+   c.execute(members_query.format(queue, WHERES[queue]))
+   members = [row[0] for row in c.fetchall()]
+   c.execute(changed_query.format(queue, WHERES[queue], OBS_Names[queue]),
+             (marks['jd'], marks['ut'], marks['time']))
+   changed = [row[0] for row in c.fetchall()]
+   return members,changed
+
+def syncQueue(queue, marks):
+   '''Incremental version of getQueue(): only fetch the targets whose
+   photometry, priority or cadence changed since marks were taken.
+
+   Returns:
+      (marks, members, data):  the new high-water marks, the SNIDs currently
+                               in the queue and qData() for the changed
+                               targets (None if nothing changed)'''
+   with pool.connection() as db:
+      c = db.cursor()
+      newmarks = qMarks(c, queue)
+      members,changed = qChanged(c, queue, marks)
+      data = qData(queue, db=db, only=changed) if changed else None
+   if changed:
+      queueCache.invalidate(queue)
+   return newmarks,members,data
+
+def reduceSky(im, size=None):
+   '''Downsample a PIL image by an integer factor to about size pixels on
+   a side (JPEGs are decoded at the reduced size). None or 0:  no change'''
+   if size and max(im.size) > size:
+      im.draft('RGB', (size,size))
+      factor = max(im.size)//size
+      if factor > 1:
+         im = im.reduce(factor)
+   return im
+
+def decodeSky(im, format='bokeh', size=None):
+   '''Convert a PIL image of the sky into image arrays
+      formats:  'bokeh' for inclusion in Bokeh plots
+                'numpy' for NxMx4 np arrays (uint8)
+      size:  if given, the image is downsampled (see reduceSky)'''
+   arr = np.asarray(reduceSky(im, size).convert('RGBA'))
+   if format=='numpy':  return arr
+
+   # Bokeh weird RGBA format: rows bottom-up, one uint32 per pixel
+   return np.ascontiguousarray(arr[::-1]).view(np.uint32)[:,:,0]
+
+def getLCOsky(format='bokeh', size=None):
    '''Retrieve the LCO all-sky image and return as image arrays
       formats:  'bokeh' for inclusion in Bokeh plots
-                'numpy' for NxNx4 np arrays'''
-   im = Image.open(requests.get('https://weather-dev.lco.cl/media/casca/red/latestimage.jpeg', 
-                                stream=True).raw)
+                'numpy' for NxNx4 np arrays
+      size:  downsample (see decodeSky). Default: SKY_SIZE'''
+   im = Image.open(requests.get(SKY_URL, stream=True, timeout=SKY_TIMEOUT).raw)
    #im = Image.open(requests.get('https://weather.lco.cl/casca/latestred.png', 
    #                             stream=True).raw)
-   arr = np.array(im.getdata()).reshape(im.size[0],im.size[1],4)
-   if format=='numpy':  return arr
+   return decodeSky(im, format, SKY_SIZE if size is None else size)
+
+class SkyFetcher:
+   '''Keeps the latest LCO all-sky image, fetched on a worker thread so
+   that nobody waits on the weather server longer than they want to.
+   Requests are conditional (ETag/If-Modified-Since), so an unchanged image
+   is neither downloaded nor decoded again. The browsers load the frames as
+   JPEGs (see skyring.py), so frames are kept as plain RGB arrays (top row
+   first), not in Bokeh's image format (see decodeSky). If a fetch fails, the last good
+   frame is kept and the error is reported in status().
+
+   Args:
+      url(str):  URL of the image. Default: SKY_URL
+      timeout(float):  request timeout (s). Default: SKY_TIMEOUT
+      ttl(float):  a new fetch is only started if the last one is older
+                   than this (s), unless forced. Default: SKY_TTL
+      size(int):  downsample to this many pixels (see reduceSky).
+                  Default: SKY_SIZE
+      ring(FrameRing):  if given, each new frame is also added to it
+                        (see skyring.py)
+      static(str):  if given (and not ring), a FrameRing writing its JPEGs
+                    to this directory is made when first needed'''
+
+   def __init__(self, url=None, timeout=None, ttl=None, size=None,
+                ring=None, static=None):
+      self.url = SKY_URL if url is None else url
+      self.ring = ring
+      self.static = static
+      self.size = SKY_SIZE if size is None else size
+      self.timeout = SKY_TIMEOUT if timeout is None else timeout
+      self.ttl = SKY_TTL if ttl is None else ttl
+      self.session = requests.Session()
+      self.worker = ThreadPoolExecutor(max_workers=1)
+      self.lock = threading.Lock()
+      self.future = None
+      self.validators = {}
+      self.image = None      # last good frame
+      self.time = None       # when it was taken (Last-Modified) or fetched
+      self.checked = None    # last time we asked the server
+      self.error = None      # why the last fetch failed
+      self.ringLock = threading.Lock()
+      if ring is not None:
+         self.startFrom(ring)
+
+   def startFrom(self, ring):
+      if len(ring):
+         # Start from the last frame of the previous run
+         self.image,self.time = ring.frame(-1)
+
+   def getRing(self):
+      '''The FrameRing (made on first use if static was given), or None'''
+      with self.ringLock:
+         if self.ring is None and self.static is not None:
+            self.ring = FrameRing(static=self.static)
+            with self.lock:
+               if self.image is None:
+                  self.startFrom(self.ring)
+         return self.ring
+
+   def close(self):
+      '''Close the ring (see FrameRing.close)'''
+      with self.ringLock:
+         self.static = None
+         if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+   def fetch(self):
+      '''Fetch the image if it changed (blocking)'''
+      try:
+         r = self.session.get(self.url, headers=self.validators,
+                              timeout=self.timeout)
+         if r.status_code == 304:
+            with self.lock:
+               self.checked = time.time()
+               self.error = None
+            return
+         r.raise_for_status()
+         im = reduceSky(Image.open(io.BytesIO(r.content)), self.size)
+         img = np.asarray(im.convert('RGB'))
+         validators = {}
+         taken = time.time()
+         if 'ETag' in r.headers:
+            validators['If-None-Match'] = r.headers['ETag']
+         if 'Last-Modified' in r.headers:
+            validators['If-Modified-Since'] = r.headers['Last-Modified']
+            try:
+               taken = parsedate_to_datetime(r.headers['Last-Modified']).\
+                       timestamp()
+            except:
+               pass
+         ring = self.getRing()
+         if ring is not None:
+            ring.add(img, taken, im)
+         with self.lock:
+            self.image = img
+            self.time = taken
+            self.checked = time.time()
+            self.validators = validators
+            self.error = None
+      except Exception as e:
+         with self.lock:
+            self.checked = time.time()
+            self.error = "{}: {}".format(type(e).__name__, e)
+         print("SkyFetcher: "+self.error)
+
+   def latest(self, wait=0, force=False):
+      '''Start a fetch in the background (if none is running and the last
+      one is older than ttl, or force), wait at most wait seconds for it and
+      return status()'''
+      with self.lock:
+         idle = self.future is None or self.future.done()
+         due = force or self.checked is None or \
+               time.time() - self.checked > self.ttl
+         if idle and due:
+            self.future = self.worker.submit(self.fetch)
+         future = self.future
+      if wait > 0 and future is not None:
+         try:
+            future.result(timeout=wait)
+         except FutureTimeout:
+            pass
+      return self.status()
+
+   def status(self):
+      '''dict(image=last good frame (RGB array) or None, time=when it was
+      taken, age=its age (s), error=why the last fetch failed or None,
+      frames=the frames in the ring, see FrameRing.index())'''
+      ring = self.getRing()
+      frames = None if ring is None else ring.index()
+      with self.lock:
+         return dict(image=self.image, time=self.time, error=self.error,
+                     age=None if self.time is None else time.time()-self.time,
+                     frames=frames)
 
-   # Boheh weird RGBA format
-   img = np.empty((im.size[0],im.size[1]), dtype=np.uint32)
-   view = img.view(dtype=np.uint8).reshape((im.size[0],im.size[1],4))
-   view[:,:,0] = arr[::-1,::,0]
-   view[:,:,1] = arr[::-1,::,1]
-   view[:,:,2] = arr[::-1,::,2]
-   view[:,:,3] = arr[::-1,::,3]
-   return img
+# The ring is only made when the server uses it (see skyring.py)
+skyFetcher = SkyFetcher(static=SKY_STATIC)
 
 def getMagPointing(tel='BAADE'):
    '''If sam.lco.cl is available, get the current poining of BAADE or CLAY'''
@@ -0,0 +1,137 @@
+'''scheduler.py:  one background thread that runs the periodic jobs shared
+by all sessions (e.g., fetching the sky image) and pushes the results to
+each subscribed session with doc.add_next_tick_callback().
+
+Jobs run at multiples of their period. A job that starts more than one
+period late (because the one before it took too long) has missed its
+deadline:  the skipped runs are counted and it is re-aligned rather than
+run several times in a row. scheduler.stats() gives the timing of each job.
+'''
+
+import os
+import time
+import threading
+import traceback
+from functools import partial
+
+# Print a line for each job run if set
+SCHED_LOG = os.environ.get('MAGDASH_SCHED_LOG', '0') == '1'
+
+class Job:
+   def __init__(self, name, func, period):
+      self.name = name
+      self.func = func
+      self.period = period
+      self.due = (time.time()//period + 1)*period
+      self.subscribers = []
+      self.runs = 0
+      self.missed = 0
+      self.last = None       # duration (s) of the last run
+      self.total = 0.0
+      self.longest = 0.0
+      self.lateness = 0.0    # how late (s) the last run started
+
+class Scheduler:
+
+   def __init__(self):
+      self.jobs = {}
+      self.lock = threading.Lock()
+      self.wake = threading.Event()
+      self.thread = None
+      self.stopping = False
+
+   def addJob(self, name, func, period):
+      '''Add a job that calls func() every period seconds. Does nothing if
+      a job with that name exists (so each session can safely add the
+      jobs it needs).'''
+      with self.lock:
+         if name not in self.jobs:
+            self.jobs[name] = Job(name, func, period)
+      self.start()
+      self.wake.set()
+
+   def subscribe(self, name, doc, callback):
+      '''Call callback(result) in doc's session after each run of job
+      name'''
+      with self.lock:
+         self.jobs[name].subscribers.append((doc, callback))
+
+   def unsubscribe(self, doc):
+      '''Remove all the subscriptions of doc (e.g., when its session is
+      destroyed)'''
+      with self.lock:
+         for job in self.jobs.values():
+            job.subscribers = [s for s in job.subscribers if s[0] is not doc]
+
+   def start(self):
+      with self.lock:
+         if self.thread is not None and self.thread.is_alive():
+            return
+         self.stopping = False
+         self.thread = threading.Thread(target=self.run, daemon=True,
+                                        name='magDash-scheduler')
+         self.thread.start()
+
+   def stop(self):
+      self.stopping = True
+      self.wake.set()
+      if self.thread is not None:
+         self.thread.join()
+         self.thread = None
+      self.wake.clear()
+
+   def run(self):
+      while not self.stopping:
+         with self.lock:
+            job = min(self.jobs.values(), key=lambda j: j.due, default=None)
+         wait = 60 if job is None else job.due - time.time()
+         if wait > 0:
+            self.wake.wait(wait)
+            self.wake.clear()
+            continue
+         self.runJob(job)
+
+   def runJob(self, job):
+      start = time.time()
+      job.lateness = start - job.due
+      if job.lateness > job.period:
+         skipped = int(job.lateness//job.period)
+         job.missed += skipped
+         print("scheduler: {} missed {} deadline(s), {:.1f}s late".format(
+            job.name, skipped, job.lateness))
+      job.due = (start//job.period + 1)*job.period
+      try:
+         result = job.func()
+      except:
+         print(traceback.format_exc())
+         return
+      job.last = time.time() - start
+      job.runs += 1
+      job.total += job.last
+      job.longest = max(job.longest, job.last)
+      if job.last > job.period:
+         print("scheduler: {} took {:.1f}s, longer than its period".format(
+            job.name, job.last))
+      if SCHED_LOG:
+         print("scheduler: {} took {:.3f}s ({:.3f}s late)".format(job.name,
+               job.last, job.lateness))
+
+      with self.lock:
+         subscribers = list(job.subscribers)
+      for doc,callback in subscribers:
+         try:
+            doc.add_next_tick_callback(partial(callback, result))
+         except:
+            # The session is gone
+            self.unsubscribe(doc)
+
+   def stats(self):
+      '''Timing of each job:  dict of name -> dict(runs, missed, last, mean,
+      longest, lateness, sessions)'''
+      with self.lock:
+         return dict([(job.name, dict(runs=job.runs, missed=job.missed,
+            last=job.last, mean=job.total/job.runs if job.runs else None,
+            longest=job.longest, lateness=job.lateness,
+            sessions=len(job.subscribers))) for job in self.jobs.values()])
+
+scheduler = Scheduler()
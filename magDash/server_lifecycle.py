@@ -0,0 +1,26 @@
+'''server_lifecycle.py:  Bokeh server hooks. Fills the shared cache (see
+shared.py) when the server starts, so that the first session doesn't have
+to wait for it. At the end, stops the scheduler (scheduler.py) and removes
+the ring of sky frames (skyring.py).'''
+
+import traceback
+from . import query
+from .shared import sharedCache
+from .plot_skyview_bokeh import SkyMap
+from .skyoverlay import starIndex
+from .scheduler import scheduler
+
+def on_server_loaded(server_context):
+   try:
+      sharedCache.night()
+      sharedCache.nightParams()
+      SkyMap().computeConAltAz()
+      starIndex()
+      sharedCache.skyImage()
+   except:
+      print(traceback.format_exc())
+
+def on_server_unloaded(server_context):
+   scheduler.stop()
+   sharedCache.clear()
+   query.skyFetcher.close()
@@ -0,0 +1,84 @@
+'''shared.py:  process-wide cache of what every dashboard session needs.
+
+Bokeh runs main.py once per session, but the modules it imports only once
+per process, so the entries here (the night grid and ephemerides, the
+constellation lines' alt/az, the latest LCO sky image) are computed once and
+shared by all sessions. Sessions must treat them as read-only (numpy arrays
+are flagged non-writeable). server_lifecycle.py fills the cache when the
+server starts. The POISE queues are shared the same way (query.queueCache).
+'''
+
+import time
+import threading
+import numpy as np
+from . import query
+from .compute import computeNightQuantities,computeNightParams,calendar
+
+def freeze(value):
+   '''Flag the numpy arrays in value (and in its dict/list/tuple members)
+   as read-only'''
+   if isinstance(value, np.ndarray):
+      value.flags.writeable = False
+   elif isinstance(value, dict):
+      for v in value.values(): freeze(v)
+   elif isinstance(value, (list,tuple)):
+      for v in value: freeze(v)
+   return value
+
+class SharedCache:
+   '''Entries are computed on first use. An entry is re-computed when its
+   tag changes (e.g., the night or the minute it is for) or when it is
+   older than its ttl. Only one thread computes a given entry, the others
+   wait for the result.'''
+
+   def __init__(self):
+      self.entries = {}
+      self.locks = {}
+      self.lock = threading.Lock()
+
+   def get(self, key, compute, tag=None, ttl=None, force=False):
+      with self.lock:
+         keylock = self.locks.setdefault(key, threading.Lock())
+      with keylock:
+         entry = self.entries.get(key)
+         if force or entry is None or entry['tag'] != tag or \
+               (ttl is not None and time.time() - entry['time'] > ttl):
+            entry = dict(tag=tag, time=time.time(), value=freeze(compute()))
+            self.entries[key] = entry
+      return entry['value']
+
+   def age(self, key):
+      '''Age (seconds) of an entry, None if not cached'''
+      entry = self.entries.get(key)
+      return None if entry is None else time.time() - entry['time']
+
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+
+   def night(self, location='LCO'):
+      '''computeNightQuantities() with no targets:  the time grid and
+      events of tonight'''
+      def compute():
+         data = dict(RA=np.array([]), DE=np.array([]), alts=np.array([]),
+                     alt=np.array([]), az=np.array([]), ID=[],
+                     AM=np.array([]), Name=[], comm=[])
+         return computeNightQuantities(data, location=location)
+      return self.get(('night',location), compute,
+                      tag=calendar.nightOf(location=location))
+
+   def nightParams(self, location='LCO'):
+      '''computeNightParams() for tonight'''
+      return self.get(('params',location),
+                      lambda: computeNightParams(location=location),
+                      tag=calendar.nightOf(location=location))
+
+   def skyImage(self, wait=0, force=False):
+      '''The latest LCO all-sky image and its age (see 
+      query.SkyFetcher.latest). Never waits more than wait seconds for the
+      weather server.'''
+      sky = query.skyFetcher.latest(wait, force)
+      freeze(sky['image'])
+      return sky
+
+sharedCache = SharedCache()
@@ -0,0 +1,91 @@
+'''skyoverlay.py:  things drawn over the sky map (constellation lines, 
+bright stars)
+
+Each overlay is a float64 array of shape (ncolumns, N), one row per column
+listed in OVERLAYS, saved as <name>.v<OVERLAY_VERSION>.npy in OVERLAY_DIR.
+It is memory-mapped read-only the first time it is used and the map is
+shared by all sessions. Bump OVERLAY_VERSION (and re-save) if the layout
+of an overlay changes.'''
+
+import os
+import sys
+import numpy as np
+from functools import cache
+
+OVERLAY_VERSION = 2
+OVERLAY_DIR = os.environ.get('MAGDASH_OVERLAYS', os.path.dirname(
+   os.path.abspath(__file__)))
+
+# The columns of each overlay
+OVERLAYS = dict(
+   # Constellation line segments:  ICRS RA/DEC (degrees) of both ends
+   conlines=('ra1', 'ra2', 'dec1', 'dec2'),
+   # Bright stars:  J2000 RA/DEC (degrees) and Hipparcos Hp magnitude,
+   # brightest first
+   stars=('ra', 'dec', 'mag'),
+)
+
+# Magnitude tiers of the stars:  faintest magnitude of each
+STAR_TIERS = (4.0, 5.0, 6.0)
+
+def overlayFile(name, path=None):
+   return os.path.join(OVERLAY_DIR if path is None else path,
+                       '{}.v{}.npy'.format(name, OVERLAY_VERSION))
+
+def saveOverlay(name, columns, path=None):
+   '''Save overlay name. columns is a dict with the columns listed in 
+   OVERLAYS[name], all of the same length.'''
+   arr = np.array([columns[key] for key in OVERLAYS[name]], dtype=np.float64)
+   np.save(overlayFile(name, path), arr)
+
+@cache
+def loadOverlay(name):
+   '''Overlay name as a dict of read-only columns (rows of the memory map)'''
+   keys = OVERLAYS[name]
+   arr = np.load(overlayFile(name), mmap_mode='r')
+   if arr.dtype != np.float64 or arr.ndim != 2 or arr.shape[0] != len(keys):
+      raise ValueError("{} is not a version {} {} overlay".format(
+         overlayFile(name), OVERLAY_VERSION, name))
+   return dict(zip(keys, arr))
+
+def readHipparcos(filename, maglim=STAR_TIERS[-1], epoch=2000.0):
+   '''The stars brighter than maglim in the Hipparcos catalog, new 
+   reduction (van Leeuwen 2007, CDS I/311 hip2.dat), moved from the 
+   catalog epoch (J1991.25) to epoch with their proper motions. Returns a
+   dict of the stars overlay columns, brightest first.'''
+   cat = np.genfromtxt(filename, usecols=(4,5,7,8,19))
+   ra,dec,pmra,pmdec,mag = cat[cat[:,4] <= maglim].T
+   dt = (epoch - 1991.25)/3.6e6    # mas -> degrees, times years
+   dec = np.degrees(dec) + pmdec*dt
+   ra = np.mod(np.degrees(ra) + pmra*dt/np.cos(np.radians(dec)), 360)
+   order = np.argsort(mag, kind='stable')
+   return dict(ra=ra[order], dec=dec[order], mag=mag[order])
+
+class StarIndex:
+   '''The stars overlay as ICRS unit vectors, brightest first, so a
+   magnitude tier is a slice. A query cuts the slice to a circle on the 
+   sky in one vectorized test. (With a few thousand stars this is faster
+   than a spatial index of cells.)'''
+
+   def __init__(self, stars):
+      ra,dec = np.radians(stars['ra']),np.radians(stars['dec'])
+      self.mag = np.array(stars['mag'])
+      self.vecs = np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                            np.sin(dec)])
+
+   def query(self, center, radius, maglim=STAR_TIERS[-1]):
+      '''Indices (brightest first) of the stars brighter than maglim within
+      radius (radians) of center (ICRS unit vector)'''
+      n = np.searchsorted(self.mag, maglim, side='right')
+      inside = center @ self.vecs[:,:n] >= np.cos(min(radius, np.pi))
+      return np.nonzero(inside)[0]
+
+@cache
+def starIndex():
+   '''StarIndex of the stars overlay, built on first use'''
+   return StarIndex(loadOverlay('stars'))
+
+if __name__ == '__main__':
+   # Re-make the stars overlay from the Hipparcos catalog:
+   #   python skyoverlay.py hip2.dat
+   saveOverlay('stars', readHipparcos(sys.argv[1]))
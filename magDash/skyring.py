@@ -0,0 +1,161 @@
+'''skyring.py:  ring buffer of the last LCO all-sky frames.
+
+The frames (RGB uint8 arrays, top row first) live in a memory-mapped .npy
+file of fixed size, so memory and disk stay bounded no matter how long the
+server runs. By default each server process has its 
+own ring in a temporary directory, removed by close(). Set MAGDASH_SKY_RING
+to keep the frames (and their JPEGs) across restarts (one directory per 
+server process). A JPEG copy of each frame is written to the static 
+directory for the browsers (see main.py's replay slider).'''
+
+import os
+import io
+import hashlib
+import shutil
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+from numpy.lib.format import open_memmap
+
+# Number of frames kept and where
+RING_FRAMES = int(os.environ.get('MAGDASH_SKY_FRAMES', 120))
+RING_PATH = os.environ.get('MAGDASH_SKY_RING', None)
+
+META = np.dtype([('time', 'f8'), ('version', 'U12')])
+
+class FrameRing:
+   '''Fixed-size ring buffer of sky frames.
+
+   Args:
+      path(str):  directory for the memory-mapped frames.npy/meta.npy.
+                  Default: RING_PATH, or a new temporary directory
+      nframes(int):  number of frames kept
+      static(str):  if given, a JPEG of each frame (see fileName(), one per
+                    slot) is written to this directory'''
+
+   def __init__(self, path=RING_PATH, nframes=RING_FRAMES, static=None):
+      self.temporary = path is None
+      if path is None:
+         path = tempfile.mkdtemp(prefix='magDash-sky-')
+      self.path = path
+      # Tells the JPEGs of different rings apart
+      self.tag = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:8]
+      self.nframes = nframes
+      self.static = static
+      self.lock = threading.Lock()
+      self.frames = None
+      os.makedirs(path, exist_ok=True)
+      try:
+         self.meta = open_memmap(self._file('meta'), mode='r+')
+         self.frames = open_memmap(self._file('frames'), mode='r+')
+         if self.meta.dtype != META or self.meta.shape != (nframes,) or \
+               self.frames.shape[0] != nframes:
+            raise ValueError("ring changed size")
+      except (OSError, ValueError):
+         self.meta = open_memmap(self._file('meta'), mode='w+', dtype=META,
+                                 shape=(nframes,))
+         self.meta['time'] = np.nan
+         self.frames = None
+      self.head = (self.order()[-1] + 1) % nframes if len(self) else 0
+      if self.static is not None:
+         # Frames kept from a previous run whose JPEG is gone
+         for slot in self.order():
+            if not os.path.isfile(os.path.join(static, self.fileName(slot))):
+               self._writeJPEG(slot, Image.fromarray(self.frames[slot]))
+
+   def _file(self, name):
+      return os.path.join(self.path, name+'.npy')
+
+   def fileName(self, slot):
+      '''Name of the JPEG of a slot in the static directory'''
+      return "sky-{}-{:03d}.jpg".format(self.tag, slot)
+
+   def _writeJPEG(self, slot, im):
+      buf = io.BytesIO()
+      im.convert('RGB').save(buf, format='JPEG', quality=85)
+      fd,tmp = tempfile.mkstemp(dir=self.static, suffix='.tmp')
+      with os.fdopen(fd, 'wb') as f:
+         f.write(buf.getvalue())
+      os.replace(tmp, os.path.join(self.static, self.fileName(slot)))
+
+   def order(self):
+      '''Slots holding frames, oldest first'''
+      times = self.meta['time']
+      slots = np.nonzero(~np.isnan(times))[0]
+      return slots[np.argsort(times[slots], kind='stable')]
+
+   def __len__(self):
+      return int(np.sum(~np.isnan(self.meta['time'])))
+
+   def add(self, img, t, im=None):
+      '''Add a frame (RGB array) taken at t (unix time), overwriting the
+      oldest. im is the PIL image for the JPEG copy. Returns the version of
+      the frame (a hash of its content).'''
+      with self.lock:
+         if self.frames is None or self.frames.shape[1:] != img.shape or \
+               self.frames.dtype != img.dtype:
+            # First frame or the frame size changed:  start over
+            self.frames = open_memmap(self._file('frames'), mode='w+',
+                  dtype=img.dtype, shape=(self.nframes,)+img.shape)
+            self.meta['time'] = np.nan
+            self.head = 0
+         version = hashlib.sha1(img).hexdigest()[:12]
+         slots = self.order()
+         if len(slots) and self.meta['version'][slots[-1]] == version:
+            # Same as the latest frame
+            return version
+         slot = self.head
+         # Not a frame while it is written
+         self.meta['time'][slot] = np.nan
+         self.frames[slot] = img
+         if self.static is not None and im is not None:
+            self._writeJPEG(slot, im)
+         self.meta[slot] = (t, version)
+         self.frames.flush()
+         self.meta.flush()
+         self.head = (slot + 1) % self.nframes
+      return version
+
+   def frame(self, i, copy=False):
+      '''Frame i (0 the oldest, -1 the latest) and its time. Without copy,
+      a view of the memory map:  it stays valid until its slot is re-used 
+      (after nframes more frames, sooner for the oldest ones).'''
+      with self.lock:
+         slot = self.order()[i]
+         img = self.frames[slot]
+         return (img.copy() if copy else img),self.meta['time'][slot]
+
+   def at(self, t, copy=False):
+      '''The last frame taken at or before t (unix time) and its time. The
+      oldest frame if t is before all of them.'''
+      with self.lock:
+         slots = self.order()
+         i = np.searchsorted(self.meta['time'][slots], t, side='right') - 1
+         slot = slots[max(i, 0)]
+         img = self.frames[slot]
+         return (img.copy() if copy else img),self.meta['time'][slot]
+
+   def index(self):
+      '''The frames, oldest first:  dict(file=JPEG file names, version=
+      their versions, time=unix times)'''
+      with self.lock:
+         slots = self.order()
+         return dict(file=[self.fileName(slot) for slot in slots],
+                     version=self.meta['version'][slots].tolist(),
+                     time=self.meta['time'][slots].tolist())
+
+   def close(self):
+      '''If the ring is temporary, remove it and its JPEGs. A ring in
+      MAGDASH_SKY_RING keeps both for the next run.'''
+      with self.lock:
+         if self.static is not None and self.temporary:
+            for slot in range(self.nframes):
+               try:
+                  os.remove(os.path.join(self.static, self.fileName(slot)))
+               except OSError:
+                  pass
+         self.frames = None
+         self.meta = None
+         if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,111 @@
+'''targettable.py:  columnar table of targets.
+
+The target lists from the CSP database (query.qData) and the Magellan
+catalogs (data.readMagCat) are TargetTables:  a dict whose per-target entries
+are numpy columns of the same length. Numbers are int/float columns, strings
+str columns and anything else (dates, None, mixed) object columns.'''
+
+import numpy as np
+from datetime import date
+
+def column(values):
+   '''Convert a sequence of values to a column array. Numbers with some
+   None become float (None -> nan), all None stays object.'''
+   values = np.asarray(values)
+   if values.dtype == object and len(values):
+      try:
+         isnum = [v is None or isinstance(v, (int,float)) and \
+                  not isinstance(v, bool) for v in values]
+      except TypeError:
+         return values
+      if all(isnum) and any([v is not None for v in values]):
+         return np.array([np.nan if v is None else v for v in values],
+                         dtype=float)
+   return values
+
+def blank(col):
+   '''The value used for a column in rows that don't have it (e.g.,
+   standards):  zero for numbers, '' for strings. For object columns,
+   the same rules as the last value (None stays None, dates get 2024-01-01)'''
+   if col.dtype.kind in 'biuf':
+      return col.dtype.type(0)
+   if col.dtype.kind == 'U':
+      return ''
+   if len(col) == 0 or col[-1] is None:
+      return None
+   if isinstance(col[-1], date):
+      return date(2024,1,1)
+   return col[-1]*0
+
+def promote(col, values):
+   '''col, converted (if needed) so that it can hold values'''
+   try:
+      dtype = np.result_type(col, values)
+   except TypeError:
+      dtype = np.dtype(object)
+   if dtype != col.dtype:
+      col = col.astype(dtype)
+   return col
+
+class TargetTable(dict):
+   '''A dict of per-target columns (listed in self.columns), all numpy
+   arrays of the same length. Other entries (e.g., 'N', 'marks' or the
+   night quantities from computeNightQuantities) are kept as in a plain
+   dict.
+
+   Args:
+      columns(dict):  initial columns (anything column() understands)'''
+
+   def __init__(self, columns=None):
+      super().__init__()
+      self.columns = []
+      if columns is not None:
+         for key in getattr(columns, 'columns', columns):
+            self.addColumn(key, columns[key])
+
+   def __copy__(self):
+      new = TargetTable()
+      new.update(self)
+      new.columns = list(self.columns)
+      return new
+
+   def addColumn(self, key, values):
+      '''Add (or replace) a per-target column'''
+      self[key] = column(values)
+      if key not in self.columns:
+         self.columns.append(key)
+
+   def nrows(self):
+      if not self.columns:
+         return 0
+      return len(self[self.columns[0]])
+
+   def categories(self, key):
+      '''Categorical form of column key:  (unique values, integer codes)'''
+      return np.unique(np.asarray(self[key], dtype=str), return_inverse=True)
+
+   def merge(self, other, key='RA'):
+      '''Insert the rows of other (a dict of columns) so that column key
+      stays sorted. Columns missing in other are filled with blank(); columns
+      of other that aren't in the table are ignored.'''
+      other = TargetTable(other)
+      order = np.argsort(other[key], kind='stable')
+      idx = np.searchsorted(self[key], other[key][order])
+      n = len(idx)
+      for col in self.columns:
+         if col in other.columns:
+            values = other[col][order]
+         else:
+            values = np.full(n, blank(self[col]),
+                             dtype=self[col].dtype if self[col].dtype.kind \
+                                   in 'biufU' else object)
+         self[col] = np.insert(promote(self[col], values), idx, values)
+
+   def setRows(self, idx, other, skip=()):
+      '''Replace rows idx with the rows of other (a dict of columns in the
+      same order as idx)'''
+      other = TargetTable(other)
+      for col in other.columns:
+         if col in skip or col not in self.columns: continue
+         self[col] = promote(self[col], other[col])
+         self[col][idx] = other[col]